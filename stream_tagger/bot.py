@@ -7,8 +7,9 @@ from discord.ext import commands as cm
 
 from .admin_config import Settings
 from .help_strings import bot_desc
-from .streams import update_channels_list
+from .streams import close_session, update_channels_list
 from .tag_command import Tagging
+from .ytdl_extractor import close_ytdl
 
 
 logger = logging.getLogger("taggerbot")
@@ -36,6 +37,11 @@ class TaggerBot(cm.Bot):
         if not self.owner_id:
             self.owner_id = (await self.application_info()).owner.id
 
+    async def close(self) -> None:
+        await close_session()
+        await super().close()
+        close_ytdl()
+
     async def on_ready(self):
         if self.test_guild:
             guild = dc.Object(self.test_guild)
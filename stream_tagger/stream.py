@@ -1,9 +1,10 @@
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, fields
+from operator import attrgetter
 
 import orjson
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Stream:
     unique_id: int
     stream_id: str | None  # this is unique per stream if not None
@@ -24,7 +25,7 @@ class Stream:
             if self.stream_id:
                 return self.stream_id == __o.stream_id
             else:
-                return self.__dict__ == __o.__dict__
+                return _getter(self) == _getter(__o)
         else:
             return NotImplemented
 
@@ -32,8 +33,12 @@ class Stream:
         return hash(self.stream_id) if self.stream_id else hash(id(self))
 
 
+_FIELD_NAMES = tuple(f.name for f in fields(Stream))
+_getter = attrgetter(*_FIELD_NAMES)
+
+
 def stream_dump(stream: Stream) -> bytes:
-    return orjson.dumps(asdict(stream))
+    return orjson.dumps(dict(zip(_FIELD_NAMES, _getter(stream))))
 
 def stream_load(serial_stream: bytes | str) -> Stream:
     d: dict = orjson.loads(serial_stream)
@@ -58,6 +63,6 @@ if __name__ == "__main__":
 
     print(stream_recon)
 
-    assert stream.__dict__ == stream_recon.__dict__
+    assert _getter(stream) == _getter(stream_recon)
 
     print(asdict(stream))
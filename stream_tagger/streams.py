@@ -1,17 +1,20 @@
 import asyncio as aio
+import itertools
 import logging
+import random
 import re
 import sqlite3
 import time
-from typing import Generator, Iterable, Mapping
+from datetime import datetime
+from typing import Iterable, Mapping
 from urllib import parse
 
 import aiohttp
-import dateutil.parser
+import orjson
 
 from . import CHANNELS_LIST_DB, HOLODEX_TOKEN
 from .stream import Stream
-from .utils import ExpBackoff, PersistentDict
+from .utils import ExpBackoff, PersistentDict, TTLCache
 from .ytdl_extractor import PayWalled, fetch_yt_metadata
 
 
@@ -29,9 +32,31 @@ hidden_chns = PersistentDict[str, str](
 )
 
 
+HOLODEX_CONCURRENCY = 5
+HOLODEX_MAX_RETRIES = 7
+
 _exp_backoff = ExpBackoff()
 _next_req_at = 0
 
+_shared_session: aiohttp.ClientSession | None = None
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    "The session shared by all Holodex requests, keeping its connections alive."
+    global _shared_session
+    if _shared_session is None or _shared_session.closed:
+        _shared_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=20, limit_per_host=HOLODEX_CONCURRENCY, ttl_dns_cache=300
+            )
+        )
+    return _shared_session
+
+
+async def close_session():
+    if _shared_session is not None:
+        await _shared_session.close()
+
 
 async def holodex_req(
     session: aiohttp.ClientSession,
@@ -46,7 +71,7 @@ async def holodex_req(
     https://holodex.stoplight.io/docs/holodex/ZG9jOjM4ODA4NzA-license
     """
     if not __sem:
-        __sem.append(aio.Semaphore(1))
+        __sem.append(aio.Semaphore(HOLODEX_CONCURRENCY))
     base_url = "https://holodex.net/api/v2/"
     url = parse.urljoin(base_url, end_point)
     if url_param:
@@ -57,13 +82,13 @@ async def holodex_req(
 
     async with __sem[0]:
         # async with crl:
-        while True:
-            if _exp_backoff.current_wait > 5:
-                logger.warning("Skipping holodex req due to prev repeated fails.")
-                raise Exception("Holodex high exp backoff wait.")
-            await _exp_backoff.wait()
-            await aio.sleep(_next_req_at - time.time())
+        for _ in range(HOLODEX_MAX_RETRIES + 1):
+            # Only wait if Holodex told us to, by a Retry-After or an empty bucket.
+            if (rl_wait := _next_req_at - time.time()) > 0:
+                # Spread the wake ups of the requests waiting on the same reset.
+                await aio.sleep(rl_wait + random.uniform(0, 0.5))
             logger.debug(f"Req to Holodex: {end_point} | {url_param} | {query_params}")
+            sent_at = time.time()
             async with session.get(
                 url, headers=headers, params=query_params
             ) as response:
@@ -77,18 +102,24 @@ async def holodex_req(
                     # logger.debug(f"rl_rem: {rl_rem}, reset_at: {reset_at}")
                     # crl.limit(int(rl_rem), float(reset_at))
 
-                if response.status in (403, 429) or (
-                    response.status >= 500 and not retry_after
+                if not (
+                    response.status in (403, 429)
+                    or (response.status >= 500 and not retry_after)
                 ):
-                    logger.warning(f"Received {response.status} from holodex.")
-                    _exp_backoff.backoff()
-                    continue
-                else:
                     _exp_backoff.cooldown()
+                    # An error body is not the data the caller asked for.
+                    response.raise_for_status()
 
-                    resp = await response.json()
+                    resp = orjson.loads(await response.read())
                     return resp
 
+            logger.warning(f"Received {response.status} from holodex.")
+            # The concurrent requests fail together, that's one backoff step.
+            _exp_backoff.backoff(sent_at)
+            await _exp_backoff.wait()
+
+        raise Exception(f"Holodex req failed {HOLODEX_MAX_RETRIES} retries.")
+
 
 async def _update_chn_list(
     session, chn_id: str, name: str, en_name: str | None, other_chns: Iterable
@@ -96,53 +127,101 @@ async def _update_chn_list(
     q_params = {"channel_id": chn_id, "type": "stream"}
     videos_resp = await holodex_req(session, "videos", None, q_params)
 
-    learnt_chns = {vid.get("link") for vid in videos_resp if vid.get("link")}
+    learnt_chns = {link for vid in videos_resp if (link := vid.get("link"))}
 
     known_chns = channels_list.get(chn_id, [set()])[0]
-    chn_urls = set.union(
-        {"https://www.youtube.com/channel/" + chn_id},
-        known_chns,
-        other_chns,
-        learnt_chns,
+    chn_urls = {"https://www.youtube.com/channel/" + chn_id}
+    chn_urls.update(known_chns)
+    chn_urls.update(other_chns)
+    chn_urls.update(learnt_chns)
+    chn = (tuple(chn_urls), name, en_name)
+    channels_list[chn_id] = chn
+    _chn_index.update(chn_id, chn)
+
+
+PAGES_PER_BATCH = 16
+CHNS_PER_PAGE = 50
+UPDATE_WORKERS = HOLODEX_CONCURRENCY
+
+
+def _active_chns(chn_resp: list) -> Iterable[tuple[str, str, str | None, set[str]]]:
+    return (
+        (
+            chn_info["id"],
+            chn_info["name"],
+            (chn_info["english_name"]),
+            {"https://twitter.com/" + chn_info["twitter"]}
+            if chn_info.get("twitter")
+            else set(),
+        )
+        for chn_info in chn_resp
+        if not (chn_info.get("inactive") or chn_info.get("group") == "INACTIVE")
     )
-    channels_list[chn_id] = (tuple(chn_urls), name, en_name)
 
 
 async def populate_channels_list():
     logger.info("Populating channels list.")
     # If we do too much too quickly, maybe Holodex won't like us.
-    async with aiohttp.ClientSession() as session:
-
-        # Get a list of all channels
-        all_chns = list[
-            tuple[str, str, str | None, set[str]]
-        ]()  # [(id, name, en_name, {some_other_channels})]
-        for i in range(0, 10**5, 50):
-            q_params = {"limit": 50, "offset": i, "type": "vtuber"}
-            chn_resp = await holodex_req(session, "channels", None, q_params)
-            if len(chn_resp) == 0:
+    session = await _get_session()
+
+    def chns_page(offset: int):
+        return holodex_req(
+            session,
+            "channels",
+            None,
+            {"limit": CHNS_PER_PAGE, "offset": offset, "type": "vtuber"},
+        )
+
+    # Get a list of all channels
+    all_chns = list[
+        tuple[str, str, str | None, set[str]]
+    ]()  # [(id, name, en_name, {some_other_channels})]
+    # A single probe first, most of the time a short first page means we are done.
+    chn_resp = await chns_page(0)
+    all_chns.extend(_active_chns(chn_resp))
+    last_full = len(chn_resp) == CHNS_PER_PAGE
+    # The rest of the pages are requested a batch at a time, to overlap the round trips.
+    base = CHNS_PER_PAGE
+    while last_full and base < 10**5:
+        batch_end = base + PAGES_PER_BATCH * CHNS_PER_PAGE
+        chn_resps = await aio.gather(
+            *(chns_page(i) for i in range(base, batch_end, CHNS_PER_PAGE))
+        )
+        # gather keeps the order of the offsets.
+        for chn_resp in chn_resps:
+            all_chns.extend(_active_chns(chn_resp))
+            last_full = len(chn_resp) == CHNS_PER_PAGE
+            if not last_full:
                 break
-            all_chns.extend(
-                (
-                    chn_info["id"],
-                    chn_info["name"],
-                    (chn_info["english_name"]),
-                    {"https://twitter.com/" + chn_info["twitter"]}
-                    if chn_info.get("twitter")
-                    else set(),
-                )
-                for chn_info in chn_resp
-                if not (chn_info.get("inactive") or chn_info.get("group") == "INACTIVE")
-            )
+        base = batch_end
 
-        # Find non youtube channels
+    # Find non youtube channels
+    # A few workers, so there aren't thousands of tasks alive at once.
+    queue = aio.Queue[tuple[str, str, str | None, set[str]] | None](maxsize=32)
 
-        await aio.gather(
-            *(
-                _update_chn_list(session, chn_id, name, en_name, other_chns)
-                for chn_id, name, en_name, other_chns in all_chns
-            )
-        )
+    async def worker():
+        while chn := await queue.get():
+            chn_id, name, en_name, other_chns = chn
+            await _update_chn_list(session, chn_id, name, en_name, other_chns)
+
+    async def feed():
+        for chn in all_chns:
+            await queue.put(chn)
+        for _ in range(UPDATE_WORKERS):
+            await queue.put(None)
+
+    tasks = [aio.create_task(feed())]
+    tasks.extend(aio.create_task(worker()) for _ in range(UPDATE_WORKERS))
+    try:
+        await aio.gather(*tasks)
+    finally:
+        # If one failed, don't leave the rest blocked on the queue.
+        for task in tasks:
+            task.cancel()
+
+    _chn_index.rebuild()
+    _name_cache.clear()
+    _all_names_cache.clear()
 
 
 UPDATE_INTV = 1 * 24 * 60 * 60
@@ -150,98 +229,220 @@ UPDATE_INTV = 1 * 24 * 60 * 60
 
 async def update_channels_list():
     "Periodically update the channels database."
-    while True:
-        con = sqlite3.connect(CHANNELS_LIST_DB)
+    con = sqlite3.connect(CHANNELS_LIST_DB)
+    try:
+        # Persistent on the database file, the daily bulk write then doesn't
+        # block the readers of the channels list.
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
         cur = con.cursor()
         cur.execute(
             f"""CREATE TABLE IF NOT EXISTS 'last_update' (
                 id INTEGER PRIMARY KEY ON CONFLICT REPLACE CHECK (id = 0) ,
                 last_update_ts INT DEFAULT 0)"""
         )
+        con.commit()
 
-        cur.execute("SELECT last_update_ts FROM 'last_update'")
-        fetch = cur.fetchone()
-        last_update_ts = int((fetch and fetch[0]) or 0)
-        sleep_for = UPDATE_INTV - (time.time() - last_update_ts)
-
-        await aio.sleep(sleep_for)
+        while True:
+            cur.execute("SELECT last_update_ts FROM 'last_update'")
+            fetch = cur.fetchone()
+            last_update_ts = int((fetch and fetch[0]) or 0)
+            sleep_for = UPDATE_INTV - (time.time() - last_update_ts)
 
-        await populate_channels_list()
+            await aio.sleep(sleep_for)
 
-        cur.execute("INSERT INTO 'last_update' VALUES (0, ?)", (int(time.time()),))
+            await populate_channels_list()
 
-        con.commit()
+            cur.execute(
+                "INSERT OR REPLACE INTO 'last_update' VALUES (0, ?)",
+                (int(time.time()),),
+            )
+            con.commit()
+    finally:
         con.close()
 
 
-def get_chns_from_name(
-    q_name: str,
-) -> tuple[str, tuple[str, ...], str, str | None]:
-    "return the channel id, channel urls, channel name and en name. Raise KeyError if not found."
-
-    # First check if a word starts with the query
-    for chn_id, tup in channels_list.items():
+class _ChannelIndex:
+    """In-memory search index over `channels_list`, for name queries.
+    Maps word prefixes and bigrams of the casefolded names to channel ids,
+    so a query only needs to check a few candidates.
+    Also mirrors `channels_list` itself, so queries don't hit the database.
+    """
 
-        if chn_id in hidden_chns:
-            continue
+    PREFIX_LEN = 4
+
+    def __init__(self):
+        self._built = False
+        # {chn_id: (chn_id, chn_urls, name, en_name)}, a mirror of channels_list
+        # already in the shape the queries return.
+        self._chns = dict[str, tuple[str, tuple[str, ...], str, str | None]]()
+        # {chn_id: position in channels_list}, to keep the matching order stable
+        self._order = dict[str, int]()
+        # {chn_id: (casefolded name, casefolded en_name, casefolded words)}
+        self._lc_cache = dict[str, tuple[str, str | None, list[str]]]()
+        self._prefix_index = dict[str, set[str]]()
+        self._bigram_index = dict[str, set[str]]()
+
+    def rebuild(self):
+        self._chns.clear()
+        self._order.clear()
+        self._lc_cache.clear()
+        self._prefix_index.clear()
+        self._bigram_index.clear()
+        for chn_id, chn in channels_list.items():
+            self._add(chn_id, chn)
+        self._built = True
+
+    def update(self, chn_id: str, chn: tuple[tuple[str, ...], str, str | None]):
+        "Index a channel that was just written to `channels_list`."
+        # Otherwise the lazy rebuild will pick it up.
+        if self._built:
+            self._add(chn_id, chn)
+
+    def get(self, chn_id: str) -> tuple[str, tuple[str, ...], str, str | None] | None:
+        if not self._built:
+            self.rebuild()
+        return self._chns.get(chn_id)
+
+    def _add(self, chn_id: str, chn: tuple[tuple[str, ...], str, str | None]):
+        # Stale index entries of a renamed channel are harmless,
+        # as the candidates are verified against _lc_cache.
+        chn_urls, name, en_name = chn
+        self._chns[chn_id] = (chn_id, chn_urls, name, en_name)
+        self._order.setdefault(chn_id, len(self._order))
+        lc_name = name.casefold()
+        lc_en_name = en_name.casefold() if en_name else None
+        words = lc_name.split() + (lc_en_name or "").split()
+        self._lc_cache[chn_id] = (lc_name, lc_en_name, words)
+
+        for word in words:
+            for i in range(1, min(len(word), self.PREFIX_LEN) + 1):
+                self._prefix_index.setdefault(word[:i], set()).add(chn_id)
+        for lc in (lc_name, lc_en_name or ""):
+            for i in range(len(lc) - 1):
+                self._bigram_index.setdefault(lc[i : i + 2], set()).add(chn_id)
+
+    def _sorted(self, chn_ids: Iterable[str]) -> list[str]:
+        return sorted(chn_ids, key=self._order.__getitem__)
+
+    def prefix_matches(self, q: str) -> list[str]:
+        "Ids of channels with a word starting with the casefolded query, in order."
+        if not self._built:
+            self.rebuild()
+        if q:
+            candidates = self._prefix_index.get(q[: self.PREFIX_LEN], ())
+        else:
+            candidates = self._lc_cache.keys()
+        return self._sorted(
+            chn_id
+            for chn_id in candidates
+            if any(word.startswith(q) for word in self._lc_cache[chn_id][2])
+        )
 
-        chn_urls, name, en_name = tup
-        if any(
-            word.lower().startswith(q_name.lower())
-            for word in name.split() + (en_name or "").split()
-        ):
-            return chn_id, chn_urls, name, en_name
-    # If not found, search query in string
-    for chn_id, tup in channels_list.items():
+    def substring_matches(self, q: str) -> list[str]:
+        "Ids of channels whose names contain the casefolded query, in order."
+        if not self._built:
+            self.rebuild()
+        if len(q) >= 2:
+            candidates = set.intersection(
+                *(
+                    self._bigram_index.get(q[i : i + 2], set())
+                    for i in range(len(q) - 1)
+                )
+            )
+        else:
+            candidates = self._lc_cache.keys()
+        return self._sorted(
+            chn_id
+            for chn_id in candidates
+            if q in self._lc_cache[chn_id][0]
+            or (
+                (lc_en_name := self._lc_cache[chn_id][1]) is not None
+                and q in lc_en_name
+            )
+        )
 
-        if chn_id in hidden_chns:
-            continue
 
-        chn_urls, name, en_name = tup
-        if q_name.lower() in name.lower() or (
-            en_name and q_name.lower() in en_name.lower()
-        ):
-            return chn_id, chn_urls, name, en_name
-    raise KeyError()
+_chn_index = _ChannelIndex()
 
 
-def get_all_chns_from_name(
-    q_name: str,
-) -> Generator[tuple[str, tuple[str, ...], str, str | None], None, None]:
-    """return the channel id, channel urls, channel name and en name.
-    Better fits are yielded first.
-    Raise KeyError if not found."""
+# {casefolded query: result or None if not found}
+# Hidden channels are cached for about as long by hidden_chns.
+_name_cache = TTLCache[str, tuple[str, tuple[str, ...], str, str | None] | None](
+    maxsize=512, ttl=60
+)
+_NOT_CACHED = object()
 
-    results = set()
-    # First check if a word starts with the query
-    for chn_id, tup in channels_list.items():
 
-        if chn_id in hidden_chns:
+def get_chns_from_name(
+    q_name: str,
+) -> tuple[str, tuple[str, ...], str, str | None]:
+    "return the channel id, channel urls, channel name and en name. Raise KeyError if not found."
+    q = q_name.casefold()
+
+    result = _name_cache.get(q, _NOT_CACHED)
+    if result is _NOT_CACHED:
+        result = _search_chn(q)
+        _name_cache.set(q, result)
+    if result is None:
+        raise KeyError()
+    return result
+
+
+def _search_chn(q: str) -> tuple[str, tuple[str, ...], str, str | None] | None:
+    # First check if a word starts with the query,
+    # if not found, search query in string
+    for chn_id in itertools.chain(
+        _chn_index.prefix_matches(q), _chn_index.substring_matches(q)
+    ):
+        if chn_id in hidden_chns or not (result := _chn_index.get(chn_id)):
             continue
+        return result
+    return None
 
-        chn_urls, name, en_name = tup
-        if any(
-            word.lower().startswith(q_name.lower())
-            for word in name.split() + (en_name or "").split()
-        ):
-            result = chn_id, chn_urls, name, en_name
-            yield result
-            results.add(result)
 
-    for chn_id, tup in channels_list.items():
+# {casefolded query: all fitting channels}, short lived as it only serves the
+# repeated queries of autocomplete while typing.
+_all_names_cache = TTLCache[
+    str, tuple[tuple[str, tuple[str, ...], str, str | None], ...]
+](maxsize=512, ttl=1)
 
-        if chn_id in hidden_chns:
-            continue
 
-        chn_urls, name, en_name = tup
-        if q_name.lower() in name.lower() or (
-            en_name and q_name.lower() in en_name.lower()
+def get_all_chns_from_name(
+    q_name: str,
+) -> tuple[tuple[str, tuple[str, ...], str, str | None], ...]:
+    """return the channel id, channel urls, channel name and en name,
+    of every channel that fits. Better fits are first."""
+    q = q_name.casefold()
+
+    if (cached := _all_names_cache.get(q)) is not None:
+        return cached
+
+    found = list[tuple[str, tuple[str, ...], str, str | None]]()
+    results = set[str]()
+    # First the channels with a word starting with the query
+    for chn_id in itertools.chain(
+        _chn_index.prefix_matches(q), _chn_index.substring_matches(q)
+    ):
+        if (
+            chn_id in results
+            or chn_id in hidden_chns
+            or not (result := _chn_index.get(chn_id))
         ):
-            result = chn_id, chn_urls, name, en_name
-            try:
-                results.remove(result)
-            except KeyError:
-                yield result
+            continue
+        results.add(chn_id)
+        found.append(result)
+    found_t = tuple(found)
+    _all_names_cache.set(q, found_t)
+    return found_t
+
+
+# {stream_name: (id_url, platform, info_dict, chn_url)}
+_idurl_cache = TTLCache[str, tuple[str, str, Mapping | None, str | None]](
+    maxsize=1024, ttl=60
+)
+# A channel's latest stream can change anytime, by it going live.
+CHN_IDURL_TTL = 10
 
 
 async def _get_stream_idurl(
@@ -251,35 +452,50 @@ async def _get_stream_idurl(
     youtube video id, or stream url for other platforms
     Maybe stream's info_dict.
     Maybe channel url.
+    Recent results are cached.
     """
+    if result := _idurl_cache.get(stream_name):
+        return result
+    result = await _fetch_stream_idurl(stream_name)
+    _idurl_cache.set(stream_name, result, ttl=CHN_IDURL_TTL if result[3] else None)
+    return result
+
+
+# The name of the group that matched tells the kind of the url.
+_URL_KIND_RE = re.compile(
+    r"youtube\.com/channel/(?P<yt_chn>[a-zA-Z0-9\-_]{24})(?![a-zA-Z0-9\-_])"
+    r"|youtube\.com/watch\?(?:[^#]*&)?v=(?P<yt_watch>[a-zA-Z0-9\-_]+)"
+    r"|youtu\.be/(?P<yt_short>[a-zA-Z0-9\-_]+)"
+    r"|twitch\.tv/videos/(?P<ttv_vod>\d+)"
+    r"|twitch\.tv/(?P<ttv_chn>[^/?#]+)"
+)
+
+
+async def _fetch_stream_idurl(
+    stream_name: str,
+) -> tuple[str, str, Mapping | None, str | None]:
+
+    url_match = _URL_KIND_RE.search(stream_name)
+    url_kind = url_match and url_match.lastgroup
 
     # Is it a youtube channel url?
-    if chn_id := re.search(
-        r"(?<=youtube\.com\/channel\/)([a-zA-Z0-9\-_]{24})(?![a-zA-Z0-9\-_])",
-        stream_name,
-    ):
-        stream_name = chn_id.group()  # set to channel id
+    if url_kind == "yt_chn":
+        stream_name = url_match[url_kind]  # set to channel id
 
     if "." in stream_name:  # a url
-        if "youtube.com/watch" in stream_name:
-            yt_id = stream_name.split("=")[1]
-            return yt_id, "yt", None, None
-        elif "youtu.be/" in stream_name:
-            yt_id = stream_name.split(".")[-1].split("/")[1]
+        if url_kind in ("yt_watch", "yt_short"):
+            yt_id = url_match[url_kind]
             return yt_id, "yt", None, None
 
-        elif "twitch.tv/videos/" in stream_name:  # twitch_vod
+        elif url_kind == "ttv_vod":  # twitch_vod
             twitch_url = stream_name
             return twitch_url, "ttv_vod", None, None
 
-        elif "twitch.tv/" in stream_name:  # twitch channel, either live or latest vod
+        elif url_kind == "ttv_chn":  # twitch channel, either live or latest vod
             # is it live
             info_dict = await aio.to_thread(fetch_yt_metadata, stream_name)
-            streamer_name = re.search(
-                r"(?<=\.tv\/)([a-zA-Z0-9\-_]+?)(?![a-zA-Z0-9\-_])", stream_name
-            )
-            assert streamer_name
-            chn_url = "https://www.twitch.tv/" + streamer_name.group()
+            streamer_name = url_match[url_kind]
+            chn_url = "https://www.twitch.tv/" + streamer_name
             if info_dict and info_dict.get("is_live"):  # is live
                 return (
                     info_dict.get("webpage_url", stream_name),
@@ -318,7 +534,7 @@ async def _get_stream_idurl(
     else:
         if len(stream_name) == 24:  # chn id
             # try to get stream if live
-            base_url = "https://www.youtube.com/channel/" + stream_name
+            base_url = f"https://www.youtube.com/channel/{stream_name}"
             info_dict = await aio.to_thread(fetch_yt_metadata, base_url + "/live")
 
             if info_dict and info_dict.get("is_live"):  # is live
@@ -326,22 +542,30 @@ async def _get_stream_idurl(
                     info_dict["id"],
                     "yt",
                     info_dict,
-                    "https://www.youtube.com/channel/" + stream_name,
+                    base_url,
                 )
 
             else:  # is not live, get the last was_live vod
-                info_dict_ls = await aio.to_thread(
-                    fetch_yt_metadata,
-                    base_url + "/videos?view=2&live_view=503",
-                    no_playlist=False,
-                    playlist_items=range(2),
-                )
-                info_dict_all = await aio.to_thread(
-                    fetch_yt_metadata,
-                    base_url + "/videos",
-                    no_playlist=False,
-                    playlist_items=range(2),
+                info_dict_ls, info_dict_all = await aio.gather(
+                    aio.to_thread(
+                        fetch_yt_metadata,
+                        base_url + "/videos?view=2&live_view=503",
+                        no_playlist=False,
+                        playlist_items=range(2),
+                    ),
+                    aio.to_thread(
+                        fetch_yt_metadata,
+                        base_url + "/videos",
+                        no_playlist=False,
+                        playlist_items=range(2),
+                    ),
+                    return_exceptions=True,
                 )
+                # Both are awaited, then the errors (RateLimited, PayWalled...)
+                # reach the caller as they would sequentially.
+                for result in (info_dict_ls, info_dict_all):
+                    if isinstance(result, BaseException):
+                        raise result
                 if info_dict_ls:
                     try:
                         ls_entry = info_dict_ls["entries"][0]
@@ -380,7 +604,7 @@ async def _get_stream_idurl(
                     last_live["id"],
                     "yt",
                     last_live,
-                    "https://www.youtube.com/channel/" + stream_name,
+                    base_url,
                 )
 
         elif len(stream_name) == 11:  # video id
@@ -392,6 +616,30 @@ async def _get_stream_idurl(
 chn_url_to_id = dict[str, str]()
 
 
+def _iso_to_timestamp(iso_time: str) -> int:
+    'Parse an ISO 8601 time from Holodex, like "2022-05-28T15:00:00.000Z".'
+    # fromisoformat doesn't take "Z" before Python 3.11
+    return int(datetime.fromisoformat(iso_time.replace("Z", "+00:00")).timestamp())
+
+
+# {stream_url: info_dict}
+_yt_metadata_cache = TTLCache[str, Mapping](maxsize=256, ttl=60)
+
+
+async def _cached_fetch_yt_metadata(url: str) -> Mapping | None:
+    "`fetch_yt_metadata` in a thread, reusing results fetched within the last minute."
+    if info_dict := _yt_metadata_cache.get(url):
+        return info_dict
+    info_dict = await aio.to_thread(fetch_yt_metadata, url)
+    if info_dict:
+        _yt_metadata_cache.set(url, info_dict)
+    return info_dict
+
+
+# yt-dlp keys first, then Holodex keys
+_START_TIME_KEYS = ("timestamp", "release_timestamp", "start_actual", "published_at")
+
+
 async def get_stream(stream_name: str, *, __recurse=True) -> Stream:
     "Can raise ValueError"
 
@@ -425,17 +673,17 @@ async def get_stream(stream_name: str, *, __recurse=True) -> Stream:
     # Since yt-dlp is giving us exact actual_start values, we don't need Holodex.
     if not info_dict:
         try:
-            info_dict = await aio.to_thread(fetch_yt_metadata, stream_url)
+            info_dict = await _cached_fetch_yt_metadata(stream_url)
         except PayWalled:
             # Youtube, members only
-            async with aiohttp.ClientSession() as session:
-                info_dict = await aio.wait_for(
-                    holodex_req(
-                        session, "videos/", url_param=stream_url[-11:], query_params={}
-                    ),
-                    timeout=15,
-                )
-                platform = "holodex"
+            session = await _get_session()
+            info_dict = await aio.wait_for(
+                holodex_req(
+                    session, "videos/", url_param=stream_url[-11:], query_params={}
+                ),
+                timeout=15,
+            )
+            platform = "holodex"
 
     assert info_dict
 
@@ -449,13 +697,10 @@ async def get_stream(stream_name: str, *, __recurse=True) -> Stream:
         else:
             chn_url = info_dict["channel_url"]
 
-    start_time: int | str | None = (
-        info_dict.get("timestamp")
-        or info_dict.get("release_timestamp")
-        or info_dict.get("start_actual")
-        or info_dict.get("published_at")
-        or info_dict.get("start_actual")
-    )
+    start_time: int | str | None = None
+    for key in _START_TIME_KEYS:
+        if start_time := info_dict.get(key):
+            break
     if not start_time:  # This may be a channel url (eg short channel name)
         if "channel_id" in info_dict and __recurse:
             chn_url_to_id[stream_name] = info_dict["channel_id"]
@@ -464,7 +709,7 @@ async def get_stream(stream_name: str, *, __recurse=True) -> Stream:
             raise ValueError
 
     if isinstance(start_time, str):
-        start_time = int(dateutil.parser.isoparse(start_time).timestamp())
+        start_time = _iso_to_timestamp(start_time)
 
     stream = Stream(
         unique_id=info_dict["id"],
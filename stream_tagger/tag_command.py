@@ -1,16 +1,20 @@
 import asyncio as aio
+import csv
 import enum
-import itertools
+import functools
 import logging
 import math
 import random
 import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
 from io import BytesIO
-from typing import TYPE_CHECKING, Literal, Optional
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Callable, Literal, Optional, TypeVar
 
 import discord as dc
 import discord.app_commands as ac
-import discord.utils
 from discord.ext import commands as cm
 
 from . import DEFAULT_OFFSET, EMBED_COLOR
@@ -26,6 +30,9 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger("taggerbot.tagging")
 
+KT = TypeVar("KT")
+VT = TypeVar("VT")
+
 
 class TagStyles(enum.Enum):
     classic = "classic"
@@ -38,6 +45,136 @@ class TagStyles(enum.Enum):
 
 DEF_STYLE = "alternative"
 
+LAST_DUMP_LIM = 256  # text channels whose last dump can be deleted
+
+REACTION_QUEUE_LIM = 50  # per text channel
+REACTION_WORKER_IDLE = 60
+
+_STYLE_VALUES = frozenset(sty.value for sty in TagStyles)
+# Sent as a file instead of embeds
+_FILE_STYLES = frozenset((TagStyles.yt_text.value, TagStyles.csv.value))
+# Without the stream url and tag count line
+_HEADERLESS_STYLES = _FILE_STYLES | {TagStyles.yt.value}
+
+# {option name: (key in opts_dict, parser of the value)}, for "name=value" options
+_OPT_PARSERS: dict[str, tuple[str, Callable[[str], int]]] = {
+    "start": ("start_time", str_to_time),
+    "duration": ("duration", str_to_time_d),
+    "offset": ("offset", int),
+    "min_stars": ("min_stars", int),
+}
+
+
+# {(sign(prev - curr), sign(next - curr)): tree branch from (prev, curr) levels}
+_TREE_PREFIXES: dict[tuple[int, int], Callable[[int, int], str]] = {
+    (0, 0): lambda p, c: "├",
+    (0, 1): lambda p, c: "├",
+    (0, -1): lambda p, c: "└",
+    (1, 0): lambda p, c: "├",
+    (1, 1): lambda p, c: "└",
+    (1, -1): lambda p, c: "└",
+    (-1, 0): lambda p, c: (
+        "└├" if c == 1 and p == 0 else "└" + "─" * (c - p - 1) + "┬"
+    ),
+    (-1, 1): lambda p, c: "└└" if c == 1 and p == 0 else "─" * (c - p) + "─",
+    (-1, -1): lambda p, c: "└└" if c == 1 and p == 0 else "─" * (c - p) + "─",
+}
+
+
+class _BoundedDict(OrderedDict[KT, VT]):
+    "Dict that forgets the least recently set key when above maxsize."
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __setitem__(self, key: KT, value: VT):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+
+# What is kept of a sent dump to delete it later
+_DumpRef = dc.Message | dc.PartialMessage | dc.Interaction
+
+
+def _dump_ref(msg: dc.Message | dc.Interaction) -> _DumpRef:
+    """Only the ids of a message sent by the bot are needed to delete it,
+    the whole message with its embeds isn't kept. Webhook messages of
+    interactions are kept, they are deleted through the webhook."""
+    if type(msg) is dc.Message:
+        return msg.channel.get_partial_message(msg.id)  # type: ignore
+    return msg
+
+
+@dataclass(frozen=True, slots=True)
+class _GuildConfig:
+    "The settings read on every tag."
+    quiet: bool
+    offset: int
+    private_txtchns: frozenset[int]
+    allow_bots: bool
+
+
+@dataclass(slots=True)
+class _ChannelState:
+    "What is kept per text channel."
+    last_dump: set[_DumpRef] = field(default_factory=set)
+
+
+class _ReactionBatcher:
+    """Adds reactions in the background, without a flood delaying tags.
+    Discord rate limits reactions per text channel, so each channel has its own
+    queue, drained by a worker that exits when the channel goes idle.
+    """
+
+    def __init__(self):
+        # {txtchn_id: queue of (msg, emoji)}
+        self._queues = dict[int, aio.Queue[tuple[dc.Message, str]]]()
+        self._workers = set[aio.Task]()
+
+    def add(self, msg: dc.Message, *emojis: str):
+        if (queue := self._queues.get(msg.channel.id)) is None:
+            queue = self._queues[msg.channel.id] = aio.Queue(REACTION_QUEUE_LIM)
+            worker = aio.create_task(self._worker(msg.channel.id, queue))
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+        # The reactions are only a nicety, skip them when too far behind.
+        # All or none, so that a star doesn't go on without its cross.
+        if queue.maxsize - queue.qsize() < len(emojis):
+            return
+        for emoji in emojis:
+            queue.put_nowait((msg, emoji))
+
+    async def _worker(self, txtchn_id: int, queue: aio.Queue[tuple[dc.Message, str]]):
+        backoff = 1.0
+        while True:
+            try:
+                msg, emoji = await aio.wait_for(queue.get(), REACTION_WORKER_IDLE)
+            except aio.TimeoutError:
+                # An item may have been put as the get was cancelled.
+                if queue.empty():
+                    del self._queues[txtchn_id]
+                    return
+                continue
+            while True:
+                # Permissions: read message history, add reactions
+                try:
+                    await msg.add_reaction(emoji)
+                except dc.Forbidden:
+                    pass
+                except dc.HTTPException as e:
+                    if e.status == 429:
+                        # Retry the same reaction once the limit has passed.
+                        await aio.sleep(backoff)
+                        backoff = min(backoff * 2, 60)
+                        continue
+                    logger.warning(f"Couldn't add reaction: {e!r}")
+                else:
+                    backoff = 1.0
+                break
+
 
 class Tagging(cm.Cog):
     def __init__(self, bot: "TaggerBot", database: str):
@@ -46,44 +183,93 @@ class Tagging(cm.Cog):
 
         self.tags = TagDatabase(database)
 
-        # {txtchn_id: {msg}
-        self.last_dump = dict[int, set[dc.Message | dc.Interaction]]()
+        # {guild_id: config}, valid while the configs version is unchanged
+        self._guild_cfgs = dict[int, _GuildConfig]()
+        self._guild_cfgs_version = -1
+
+        # {txtchn_id: state}, only for the most recent channels
+        self.channel_states = _BoundedDict[int, _ChannelState](LAST_DUMP_LIM)
         # {guild_id: {stream}}
         self.guild_streams = PersistentSetDict[Stream](
             database, "guild_streams", 1, dump_v=stream_dump, load_v=stream_load
         )
+        # {guild_id: [stream]}, latest first, valid while guild_streams is unchanged
+        self._sorted_streams_cache = dict[int, list[Stream]]()
+        self._sorted_streams_version = -1
+
+        # {txtchn_id: (msg, emoji)}, each drained by a worker of the channel
+        self.reaction_batcher = _ReactionBatcher()
 
         self.tags_command.add_check(bot.check_perm)
 
+    async def cog_unload(self):
+        # Also run by Bot.close, which removes the cogs.
+        await aio.to_thread(self.tags.close)
+
+    def _channel_state(self, txtchn_id: int) -> _ChannelState:
+        if (state := self.channel_states.get(txtchn_id)) is None:
+            state = _ChannelState()
+        # Set even if it exists, to mark it as recently used.
+        self.channel_states[txtchn_id] = state
+        return state
+
+    def _guild_config(self, guild_id: int) -> _GuildConfig:
+        if self._guild_cfgs_version != self.configs.version:
+            self._guild_cfgs.clear()
+            self._guild_cfgs_version = self.configs.version
+        if cfg := self._guild_cfgs.get(guild_id):
+            return cfg
+
+        cfg = self._guild_cfgs[guild_id] = _GuildConfig(
+            quiet=True in self.configs.get(("quiet", guild_id), ()),
+            offset=next(
+                iter(self.configs.get(("def_offset", guild_id), ())), DEFAULT_OFFSET
+            ),
+            private_txtchns=self.configs.get(("private_txtchn", guild_id), frozenset()),
+            allow_bots=True in self.configs.get(("allow_bots", guild_id), ()),
+        )
+        return cfg
+
+    def _sorted_streams(self, guild_id: int) -> list[Stream]:
+        "The streams of the guild, latest first."
+        if self._sorted_streams_version != self.guild_streams.version:
+            self._sorted_streams_cache.clear()
+            self._sorted_streams_version = self.guild_streams.version
+        if (streams := self._sorted_streams_cache.get(guild_id)) is None:
+            streams = self._sorted_streams_cache[guild_id] = sorted(
+                self.guild_streams.get((guild_id,), ()),
+                key=lambda s: s.start_time,
+                reverse=True,
+            )
+        return streams
+
     async def tag(
         self, msg: dc.Message, text: str, author_id: int, hierarchy=0, reactions=True
     ):
         assert msg.guild
 
-        if reactions and not any(self.configs.get(("quiet", msg.guild.id), ())):
-            # Permissions: read message history, add reactions
-            try:
-                await aio.gather(msg.add_reaction("⭐"), msg.add_reaction("❌"))
-            except dc.Forbidden:
-                pass
+        if reactions and not self._guild_config(msg.guild.id).quiet:
+            self.reaction_batcher.add(msg, "⭐", "❌")
 
-        def_offset = self.configs.get(("def_offset", msg.guild.id))
-        offset = list(def_offset)[0] if def_offset else DEFAULT_OFFSET
-        adjusted_ts = msg.created_at.timestamp() + offset
-
-        hidden = msg.channel.id in self.configs.get(
-            ("private_txtchn", msg.guild.id), ()
+        await aio.to_thread(
+            self.tags.tag, *self._tag_row(msg, text, author_id, hierarchy)
         )
 
-        self.tags.tag(
-            msg.id,
-            msg.guild.id,
-            adjusted_ts,
-            text,
-            author_id,
-            hidden=hidden,
-            hierarchy=hierarchy,
-        )
+    def _tag_row(
+        self, msg: dc.Message, text: str, author_id: int, hierarchy: int
+    ) -> tuple[int, int, float, str, int, bool, int]:
+        "The arguments of `TagDatabase.tag` for the tag."
+        assert msg.guild
+        cfg = self._guild_config(msg.guild.id)
+
+        adjusted_ts = msg.created_at.timestamp() + cfg.offset
+
+        hidden = msg.channel.id in cfg.private_txtchns
+
+        return msg.id, msg.guild.id, adjusted_ts, text, author_id, hidden, hierarchy
+
+    async def _is_tag(self, msg_id: int) -> bool:
+        return await aio.to_thread(self.tags.__contains__, msg_id)
 
     ### tag command
     @cm.command(name="tag", aliases=["t"])
@@ -98,7 +284,8 @@ class Tagging(cm.Cog):
         "Adjust time of the last tag. Cumulative."
         assert ctx.guild
         assert abs(offset) <= 7200
-        last_tags = self.tags.get_tags(
+        last_tags = await aio.to_thread(
+            self.tags.get_tags,
             ctx.guild.id,
             0,
             time.time() + 2 * 60 * 60,
@@ -108,7 +295,7 @@ class Tagging(cm.Cog):
         )
         if last_tags:
             og_ts, msg_id = last_tags[0][0], last_tags[0][3]
-            self.tags.update_time(msg_id, og_ts + offset)
+            await aio.to_thread(self.tags.update_time, msg_id, og_ts + offset)
             # last_msg = await ctx.fetch_message(msg_id)
             # Permissions: Read message history, Add reactions
             if ctx.interaction:
@@ -116,7 +303,7 @@ class Tagging(cm.Cog):
                     f"{offset} 👍", ephemeral=True
                 )
             else:
-                if not any(self.configs.get(("quiet", ctx.guild.id), ())):
+                if not self._guild_config(ctx.guild.id).quiet:
                     try:
                         await ctx.message.add_reaction("👍")
                     except dc.Forbidden:
@@ -125,40 +312,38 @@ class Tagging(cm.Cog):
     @staticmethod
     def parse_ticks(content: str) -> tuple[str, int]:
         "Return stripped content, and hierarchy. Raise ValueError if no backtick."
-        ticks = 0
-        spaces = 0
-        for c in content:
-            if c == "`":
-                ticks += 1
-            elif c == " ":
-                spaces += 1
-            else:
-                break
+        stripped = content.lstrip("` ")
+        # The backticks and spaces may be interleaved, like "` `tag".
+        ticks = content.count("`", 0, len(content) - len(stripped))
         if not ticks:
             raise ValueError
         else:
-            return content[ticks + spaces :], ticks - 1
+            return stripped, ticks - 1
 
-    ### tag with prefix
-    @cm.Cog.listener()
-    async def on_message(self, message: dc.Message, reactions=True):
+    def _parse_tag_msg(self, message: dc.Message) -> tuple[str, int] | None:
+        "Return the tag text and hierarchy if the message is a tag."
+        # Most messages aren't tags, a tag starts with backticks or spaces.
+        if not message.content.startswith(("`", " ")):
+            return
         if message.author == self.bot.user:
             return
         if message.author.bot and (  # Ignore bots unless set otherwise by the guild.
-            (
-                message.guild
-                and True not in (self.configs.get(("allow_bots", message.guild.id), []))
-            )
+            (message.guild and not self._guild_config(message.guild.id).allow_bots)
         ):
             return
         if message.author.bot and not message.guild:
             return
 
         try:
-            text, h = self.parse_ticks(message.content)
+            return self.parse_ticks(message.content)
         except ValueError:
-            pass
-        else:
+            return
+
+    ### tag with prefix
+    @cm.Cog.listener()
+    async def on_message(self, message: dc.Message, reactions=True):
+        if parsed := self._parse_tag_msg(message):
+            text, h = parsed
             await self.tag(
                 message,
                 text,
@@ -171,27 +356,31 @@ class Tagging(cm.Cog):
     ### edit a tag
     @cm.Cog.listener()
     async def on_raw_message_edit(self, payload: dc.RawMessageUpdateEvent):
-        if (content := payload.data.get("content")) and payload.message_id in self.tags:
+        if (content := payload.data.get("content")) and await self._is_tag(
+            payload.message_id
+        ):
             try:
                 text, h = self.parse_ticks(content)
             except ValueError:
                 pass
             else:
-                self.tags.update_text(payload.message_id, text, h=h)
+                await aio.to_thread(
+                    self.tags.update_text, payload.message_id, text, h=h
+                )
 
     ### vote or delete
     @cm.Cog.listener()
     async def on_reaction_add(self, reaction: dc.Reaction, user: dc.Member | dc.User):
         if user != self.bot.user and not user.bot:
-            if reaction.emoji == "⭐" and reaction.message.id in self.tags:
-                self.tags.increment_vote(reaction.message.id)
+            if reaction.emoji == "⭐" and await self._is_tag(reaction.message.id):
+                await aio.to_thread(self.tags.increment_vote, reaction.message.id)
 
             elif (
                 reaction.emoji == "❌"
                 and (reaction.message.author == user or self.bot.is_admin(user, "❌"))
-                and reaction.message.id in self.tags
+                and await self._is_tag(reaction.message.id)
             ):
-                self.tags.remove(reaction.message.id)
+                await aio.to_thread(self.tags.remove, reaction.message.id)
 
     ### remove vote
     @cm.Cog.listener()
@@ -202,8 +391,8 @@ class Tagging(cm.Cog):
         self, reaction: dc.Reaction, user: dc.Member | dc.User
     ):
         if user != self.bot.user and not user.bot:
-            if reaction.emoji == "⭐" and reaction.message.id in self.tags:
-                self.tags.increment_vote(reaction.message.id, -1)
+            if reaction.emoji == "⭐" and await self._is_tag(reaction.message.id):
+                await aio.to_thread(self.tags.increment_vote, reaction.message.id, -1)
 
     ### auto complete
     async def stream_autocomp(self, it: dc.Interaction, curr: str) -> list[ac.Choice]:
@@ -211,40 +400,40 @@ class Tagging(cm.Cog):
         AUTOCOMP_LIM = 10  # Discord's limit is 25, but a lower limit looks better
         # First look at the latest stream
         assert it.guild_id
-        streams = self.guild_streams[
-            it.guild_id,
-        ]
         # past streams in this channel
-        ordered_streams = sorted(streams, key=lambda s: s.start_time, reverse=True)
-        # every channel that fits
-        chns = list(get_all_chns_from_name(curr))
-        if not chns:
+        ordered_streams = self._sorted_streams(it.guild_id)
+        # names of the fitting channels, in order
+        fit_names = list[str]()
+        # {chn_url: names of the fitting channels with it, in order}
+        url_to_names = dict[str, list[str]]()
+        # The channel index only yields channels whose casefolded names
+        # contain the query, so every one of them fits.
+        for chn_id, chn_urls, name, en_name in get_all_chns_from_name(curr):
+            fit_names.append(name)
+            for url in chn_urls:
+                url_to_names.setdefault(url, []).append(name)
+        if not fit_names:
             return []
 
         # result list
         pos_chns = []
+        pos_chns_set = set[str]()
         for stream in ordered_streams:
             if len(pos_chns) >= AUTOCOMP_LIM:
                 break
-            for chn_id, chn_urls, name, en_name in chns:
-                en_name = en_name or ""
-                if (
-                    (curr.lower() in name.lower() or curr.lower() in en_name.lower())
-                    and stream.chn_url in chn_urls
-                    and name not in pos_chns
-                ):
+            for name in url_to_names.get(stream.chn_url, ()):
+                if name not in pos_chns_set:
                     pos_chns.append(name)
+                    pos_chns_set.add(name)
                     break
 
         if len(curr) >= 3:
-            for chn_id, chn_urls, name, en_name in chns:
+            for name in fit_names:
                 if len(pos_chns) >= AUTOCOMP_LIM:
                     break
-                en_name = en_name or ""
-                if (
-                    curr.lower() in name.lower() or curr.lower() in en_name.lower()
-                ) and name not in pos_chns:
+                if name not in pos_chns_set:
                     pos_chns.append(name)
+                    pos_chns_set.add(name)
 
         return [ac.Choice(name=name, value=name) for name in pos_chns]
 
@@ -380,40 +569,31 @@ class Tagging(cm.Cog):
         opts_dict = {}
 
         for opt in options:
+            opt_name, eq, opt_value = opt.partition("=")
             match opt:
-                case "own":
-                    opts_dict["own"] = True
-                case style if style in (
-                    sty.value for sty in TagStyles.__members__.values()
-                ):
-                    opts_dict["style"] = style
-                case start_time if start_time.startswith("start="):
-                    opts_dict["start_time"] = str_to_time(start_time[6:])
-                case duration if duration.startswith("duration="):
-                    opts_dict["duration"] = str_to_time_d(duration[9:])
-                case guild if guild.startswith("server="):
-                    guild = guild[7:]
+                case _ if eq and opt_name in _OPT_PARSERS:
+                    key, parse = _OPT_PARSERS[opt_name]
+                    opts_dict[key] = parse(opt_value)
+                case _ if eq and opt_name == "server":
+                    guild = opt_value
                     try:
                         guild_id = int(guild)
                     except ValueError:
-                        guild_id = None
-                        for g in self.bot.guilds:
-                            if g.name == guild:
-                                guild_id = g.id
-                                break
+                        guild_id = next(
+                            (g.id for g in self.bot.guilds if g.name == guild), None
+                        )
                     if not guild_id:
                         if isinstance(ctx_it, dc.Interaction):
                             await ctx_it.delete_original_message()
                         await send("Invalid server name or server id.", ephemeral=True)
                         return
                     opts_dict["guild"] = guild_id
+                case "own":
+                    opts_dict["own"] = True
+                case style if style in _STYLE_VALUES:
+                    opts_dict["style"] = style
                 case "delete" | "delete_last":
                     opts_dict["delete"] = True
-                case offset if offset.startswith("offset="):
-                    offset = int(offset[7:])
-                    opts_dict["offset"] = offset
-                case duration if duration.startswith("min_stars="):
-                    opts_dict["min_stars"] = int(duration[10:])
                 case stream_url:
                     if stream_url.startswith("<") and stream_url.endswith(">"):
                         stream_url = stream_url[1:-1]
@@ -421,9 +601,9 @@ class Tagging(cm.Cog):
 
         # If the command was called to delete the last dump, instead of a dump.
         if "delete" in opts_dict:
-            last_msg = self.last_dump.get(ctx_it.channel.id)
-            while last_msg:
-                msg = last_msg.pop()
+            state = self.channel_states.get(ctx_it.channel.id)
+            while state and state.last_dump:
+                msg = state.last_dump.pop()
                 if isinstance(msg, dc.Interaction):
                     await msg.delete_original_message()
                 else:
@@ -440,11 +620,8 @@ class Tagging(cm.Cog):
         stream_url = opts_dict.pop("stream_url", None)
         if (stream_url == "_" or not stream_url) and not "start_time" in opts_dict:
             if "guild" in opts_dict:
-                streams = self.guild_streams.get((opts_dict["guild"],))
-                if streams:
-                    streams_sorted = sorted(
-                        streams, key=lambda s: s.start_time, reverse=True
-                    )
+                streams_sorted = self._sorted_streams(opts_dict["guild"])
+                if streams_sorted:
                     stolen_stream = streams_sorted[0]
                     stream_url = stolen_stream.stream_url
                     opts_dict["start_time"] = stolen_stream.start_time
@@ -481,11 +658,9 @@ class Tagging(cm.Cog):
         else:
             guild_id = opts_dict["guild"]
 
-        def_style_set = self.bot.settings.configs.get(("def_format", guild_id))
-        if not def_style_set:
-            def_style = DEF_STYLE
-        else:
-            def_style: str = list(def_style_set)[0]
+        def_style: str = next(
+            iter(self.configs.get(("def_format", guild_id), ())), DEF_STYLE
+        )
 
         style = opts_dict.pop("style", def_style)
 
@@ -525,33 +700,26 @@ class Tagging(cm.Cog):
             await send("No tags found.", ephemeral=True)
             return
 
-        stream, tags_text = tag_dump
+        stream, tags_chunks = tag_dump
 
         # Add
         assert ctx_it.guild
         self.guild_streams.add(ctx_it.guild.id, value=stream)
 
-        if style in ("yt-text", "csv"):
+        if style in _FILE_STYLES:
             txt_f = dc.File(
-                BytesIO(bytes(tags_text, encoding="utf-8")),
+                BytesIO(bytes("\n".join(tags_chunks), encoding="utf-8")),
                 stream.stream_url + ".txt" if style == "yt-text" else ".csv",
             )
             msg = await send(file=txt_f)
-            self.last_dump[ctx_it.channel.id] = {msg or ctx_it}  # type: ignore
+            self._channel_state(ctx_it.channel.id).last_dump = {
+                _dump_ref(msg or ctx_it)  # type: ignore
+            }
             return
 
-        embed_texts: list[str] = []
-        embed_text = ""
-        for line in tags_text.splitlines(keepends=True):
-            if len(embed_text) + len(line) >= 4000:  # discord embed character limit
-                embed_texts.append(embed_text)
-                embed_text = ""
-            embed_text += line
-        embed_texts.append(embed_text)
-
         embeds = [
             dc.Embed(color=EMBED_COLOR, description=embed_text)
-            for embed_text in embed_texts
+            for embed_text in tags_chunks
         ]
         if style == "alternative":
             if "twitch.tv/" in stream.stream_url:
@@ -563,19 +731,12 @@ class Tagging(cm.Cog):
         else:
             embeds[0].title = "Tags: " + stream.stream_url
 
-        last_dump = set[dc.Message | dc.Interaction]()
+        last_dump = set[_DumpRef]()
+        # Sent one by one, so that the chunks show up in order.
         for embed in embeds:
-            if isinstance(ctx_it, dc.Interaction):
-                if ctx_it.response.is_done:
-                    it_send = ctx_it.followup.send
-                else:
-                    it_send = send
-                msg = await it_send(embed=embed)
-                last_dump.add(msg or ctx_it)
-            else:
-                msg = await ctx_it.send(embed=embed)
-                last_dump.add(msg)
-        self.last_dump[ctx_it.channel.id] = last_dump
+            msg = await send(embed=embed)
+            last_dump.add(_dump_ref(msg or ctx_it))  # type: ignore
+        self._channel_state(ctx_it.channel.id).last_dump = last_dump
 
     async def dump_tags_from_stream(
         self,
@@ -587,8 +748,8 @@ class Tagging(cm.Cog):
         start_time: int | None = None,
         duration: int | None = None,
         **opts_dict,
-    ) -> tuple[Stream, str] | None:
-        """Returns formatted string of the tags of the latest stream,
+    ) -> tuple[Stream, list[str]] | None:
+        """Returns formatted strings of the tags of the latest stream, in embed sized chunks,
         or `None` if no tags found or no latest stream.
         Raises `ValueError` if the specified `stream_url` is not found.
         """
@@ -632,7 +793,9 @@ class Tagging(cm.Cog):
                 stream_url_temp=True,
             )
 
-        tags_text = self.dump_tags(
+        # Formatting many tags takes a while, keep the event loop free meanwhile.
+        tags_chunks = await aio.to_thread(
+            self.dump_tags,
             guild_id,
             real_url,
             start_time_,
@@ -643,10 +806,10 @@ class Tagging(cm.Cog):
             offset=opts_dict.get("offset", 0),
             min_stars=opts_dict.pop("min_stars", 0),
         )
-        if not tags_text:
+        if not tags_chunks:
             return
         else:
-            return stream, tags_text
+            return stream, tags_chunks
 
     def dump_tags(
         self,
@@ -660,10 +823,11 @@ class Tagging(cm.Cog):
         url_is_perm: bool,
         offset: int = 0,
         min_stars=0,
-    ) -> str | None:
-        "Between the start and end, returns formatted string of the tags, or `None` if no tags found."
+    ) -> list[str] | None:
+        """Between the start and end, returns formatted string of the tags, split into
+        chunks that fit in an embed, or `None` if no tags found."""
 
-        if False in self.bot.settings.configs.get(("fetch_limit", guild_id), []):
+        if False in self.configs.get(("fetch_limit", guild_id), []):
             limit = 1_000_000
         else:
             limit = 1_000
@@ -676,101 +840,82 @@ class Tagging(cm.Cog):
             return None
 
         lines = list[str]()
+        # Added to a tag's timestamp to get its time relative to the start
+        shift = offset - start
 
         tags_per_minute = len(tags) / (end - start) * 60
         header_text = f"{stream_url or ''} <t:{start}:f> {len(tags)} tags ({tags_per_minute:.1f}/min)"
-        if style not in ("yt", "yt-text", "csv"):
+        if style not in _HEADERLESS_STYLES:
             lines.append(header_text)
 
         match style:
             case "classic":
                 for ts, text, vote, _, _ in tags:
-                    ts += offset
-                    relative_ts = ts - start
+                    relative_ts = ts + shift
                     line = text.replace("`", "") + (
                         (f" ({vote})" if vote else "")
                         + (
-                            f" [{td_to_str(relative_ts)}]({timestamp_link(stream_url, relative_ts)})"
+                            f" [{_td_classic(math.floor(relative_ts))}]({timestamp_link(stream_url, relative_ts)})"
                             if stream_url and url_is_perm
-                            else f" {td_to_str(relative_ts)}"
+                            else f" {_td_classic(math.floor(relative_ts))}"
                         )
                     )
                     lines.append(line)
             case "csv":
-                for ts, text, vote, _, h in tags:
-                    ts += offset
-                    relative_ts = ts - start
-                    escaped_text = '"' + text.replace('"', '""') + '"'
-                    line = ",".join((str(relative_ts), escaped_text, str(vote), str(h)))
-                    lines.append(line)
+                # Each row is written as a line of its own.
+                writer = csv.writer(
+                    SimpleNamespace(write=lines.append),
+                    quoting=csv.QUOTE_NONNUMERIC,
+                    lineterminator="",
+                )
+                writer.writerows(
+                    (ts + shift, text, vote, h) for ts, text, vote, _, h in tags
+                )
             case "info":
                 pass
             case "alternative" | "yt" | "yt-text":
                 avg_votes = sum(tag.vote for tag in tags) / len(tags)
-                adjusted_stars = lambda v: round(
-                    math.log(round(v / (avg_votes + 1)) + 1, 2)  # visually cool
-                )
-                dummy_first = Tag_t(..., ..., ..., ..., tags[0].hier)
-                dummy_last = Tag_t(..., ..., ..., ..., -1)
-                tags_d = list(itertools.chain([dummy_first], tags, [dummy_last]))
-                for i in range(len(tags)):
-                    prev_ind = tags_d[i].hier
-                    tag = tags_d[i + 1]
-                    curr_ind = tag.hier
-                    next_ind = tags_d[i + 2].hier
-                    space_indent = curr_ind - max(curr_ind - prev_ind, 0)
-                    ts = tag.ts + offset
-                    relative_ts = ts - start
-                    adj_stars = adjusted_stars(tag.vote)
-                    if style == "alternative":
-                        line = (
-                            (
-                                f"[{td_to_str(relative_ts)}]({timestamp_link(stream_url, relative_ts)}) | "
-                                if stream_url and url_is_perm
-                                else f" `{td_to_str(relative_ts)}` | "
-                            )
-                            + tag.text.replace("`", "")
-                            + (f" ({''.join(['⭐'] * adj_stars)})" if adj_stars else "")
-                        )
-                    else:
-                        escaped_text = discord.utils.remove_markdown(tag.text)
-                        line = f"{td_to_str(relative_ts, 'yt')} {tag.text}"
-                    pre = "".join(["⠀"] * space_indent)
-                    if curr_ind == prev_ind <= next_ind:
-                        pre += "├"
-                    elif prev_ind == curr_ind:
-                        pre += "└"
-                    elif prev_ind > curr_ind == next_ind:
-                        pre += "├"
-                    elif prev_ind > curr_ind:
-                        pre += "└"
-                    elif (
-                        curr_ind == 1
-                        and (curr_ind - prev_ind) == 1
-                        and curr_ind == next_ind
-                    ):
-                        pre += "└" + "├"
-                    elif prev_ind < curr_ind == next_ind:
-                        pre += "└" + "".join(["─"] * (curr_ind - prev_ind - 1)) + "┬"
-                    elif curr_ind == 1 and prev_ind == 0 and next_ind != 1:
-                        pre += "└" + "└"
-                    elif prev_ind < curr_ind:
-                        pre += "".join(["─"] * (curr_ind - prev_ind)) + "─"
-                    else:
-                        logger.error(
-                            f"Unhandled hierarchy case: {prev_ind, curr_ind, next_ind}"
-                        )
-                    if len(pre) > 1:
-                        pre += " "
-                    line = pre + line
-                    line = line[1:]
-                    if line[0] == "─":
-                        line = "└" + line[1:]
-                    lines.append(line)
+                # {votes: stars}, there are only a few distinct vote counts
+                adjusted_stars = {
+                    v: round(
+                        math.log(round(v / (avg_votes + 1)) + 1, 2)  # visually cool
+                    )
+                    for v in {tag.vote for tag in tags}
+                }
+                stars_strs = {
+                    v: f" ({'⭐' * adj_stars})" if adj_stars else ""
+                    for v, adj_stars in adjusted_stars.items()
+                }
+
+                def alt_line_link(relative_ts: float, tag: Tag_t) -> str:
+                    return (
+                        f"[{_td_classic(math.floor(relative_ts))}]({timestamp_link(stream_url, relative_ts)}) | "  # type: ignore
+                        + tag.text.replace("`", "")
+                        + stars_strs[tag.vote]
+                    )
+
+                def alt_line(relative_ts: float, tag: Tag_t) -> str:
+                    return (
+                        f" `{_td_classic(math.floor(relative_ts))}` | "
+                        + tag.text.replace("`", "")
+                        + stars_strs[tag.vote]
+                    )
+
+                def yt_line(relative_ts: float, tag: Tag_t) -> str:
+                    return f"{_td_yt(math.floor(relative_ts))} {tag.text}"
+
+                if style != "alternative":
+                    build_line = yt_line
+                elif stream_url and url_is_perm:
+                    build_line = alt_line_link
+                else:
+                    build_line = alt_line
+
+                lines += _tree_lines(tags, build_line, shift)
             case _:
                 raise ValueError
 
-        return "\n".join(lines)
+        return chunk_lines(lines, EMBED_TEXT_LIM)
 
     @cm.hybrid_command()
     @ac.default_permissions()
@@ -779,43 +924,100 @@ class Tagging(cm.Cog):
         "Load tags from this channel's history. Useful for loading tags made before adding this bot."
         if ctx.interaction:
             await ctx.interaction.response.defer(thinking=True)
-        until = time.time() - days * 24 * 3600
-        count = 0
-        async for msg in ctx.channel.history():
-            if msg.created_at.timestamp() < until:
-                break
-            if msg.id not in self.tags:
-                if await self.on_message(msg, reactions=False):
-                    count += 1
+        until = datetime.fromtimestamp(time.time() - days * 24 * 3600, tz=timezone.utc)
+        rows = []
+        async for msg in ctx.channel.history(
+            limit=None, after=until, oldest_first=True
+        ):
+            if parsed := self._parse_tag_msg(msg):
+                text, h = parsed
+                rows.append(self._tag_row(msg, text, msg.author.id, h))
+        # Already existing tags are skipped.
+        count = await aio.to_thread(self.tags.tag_many, rows)
         await ctx.send(f"Loaded {count} tags")
 
 
 def td_to_str(t: float, style: Literal["classic", "yt"] = "classic") -> str:
     "Time in seconds to a string reprsentation."
-    hours = int(t // 3600)
-    minutes = int((t // 60) % 60)
-    seconds = int(t % 60)
-
-    match style:
-        case "classic":
-            res = f"{minutes}m{seconds}s"
-        case "yt":
-            res = f"{minutes}:{seconds}"
-    if hours != 0:
-        match style:
-            case "classic":
-                res = f"{hours}h" + res
-            case "yt":
-                res = f"{hours}:" + res
-
-    return res
+    t = math.floor(t)
+    return _td_yt(t) if style == "yt" else _td_classic(t)
+
+
+# The formatters are memoized process wide, the times of a stream's tags repeat
+# across its dumps. They take whole seconds, which is all they show, so that
+# the fractional times of a second share an entry.
+@functools.lru_cache(maxsize=4096)
+def _td_classic(t: int) -> str:
+    hours, rem = divmod(t, 3600)
+    minutes, seconds = divmod(rem, 60)
+    if hours:
+        return f"{int(hours)}h{int(minutes)}m{int(seconds)}s"
+    return f"{int(minutes)}m{int(seconds)}s"
+
+
+@functools.lru_cache(maxsize=4096)
+def _td_yt(t: int) -> str:
+    hours, rem = divmod(t, 3600)
+    minutes, seconds = divmod(rem, 60)
+    if hours:
+        return f"{int(hours)}:{int(minutes)}:{int(seconds)}"
+    return f"{int(minutes)}:{int(seconds)}"
+
+
+def _tree_lines(
+    tags: list[Tag_t], build_line: Callable[[float, Tag_t], str], shift: float
+) -> list[str]:
+    """The lines of the tags, drawn as a tree by their hierarchy.
+    `build_line` gets the tag's time shifted by `shift`, and the tag."""
+    lines = list[str]()
+    append = lines.append
+    prefixes = _TREE_PREFIXES
+    last_i = len(tags) - 1
+    prev_ind = tags[0].hier
+    for i, tag in enumerate(tags):
+        curr_ind = tag.hier
+        next_ind = tags[i + 1].hier if i < last_i else -1
+        space_indent = curr_ind - max(curr_ind - prev_ind, 0)
+        line = build_line(tag.ts + shift, tag)
+        pre = "⠀" * space_indent
+        sp = (prev_ind > curr_ind) - (prev_ind < curr_ind)
+        sn = (next_ind > curr_ind) - (next_ind < curr_ind)
+        try:
+            pre += prefixes[sp, sn](prev_ind, curr_ind)
+        except KeyError:
+            logger.error(f"Unhandled hierarchy case: {prev_ind, curr_ind, next_ind}")
+        if len(pre) > 1:
+            pre += " "
+        # The first column is dropped, a line can't start with "─".
+        pre = pre[1:]
+        if pre.startswith("─"):
+            pre = "└" + pre[1:]
+        append(pre + line)
+        prev_ind = curr_ind
+    return lines
+
+
+EMBED_TEXT_LIM = 4000  # discord embed character limit
+
+
+def chunk_lines(lines: list[str], max_len: int) -> list[str]:
+    "Join the lines with newlines, in chunks shorter than max_len where possible."
+    chunks = list[str]()
+    start = 0  # index of the first line of the current chunk
+    chunk_len = 0
+    for i, line in enumerate(lines):
+        if i > start and chunk_len + len(line) + 1 >= max_len:
+            chunks.append("\n".join(lines[start:i]))
+            start = i
+            chunk_len = 0
+        chunk_len += len(line) + 1
+    if start < len(lines):
+        chunks.append("\n".join(lines[start:]))
+    return chunks
 
 
 def timestamp_link(stream_url: str, t: float) -> str:
     # Basic and not complete url modifying, but enough for our purposes.
     # Works for at least youtube and twitch.
-    stream_url = stream_url.split("#")[0]
-    if "?" in stream_url:
-        return stream_url + f"&t={int(t)}s"
-    else:
-        return stream_url + f"?t={int(t)}s"
+    base = stream_url.partition("#")[0]
+    return f"{base}{'&' if '?' in base else '?'}t={int(t)}s"
@@ -1,7 +1,13 @@
 import collections
+import logging
 import sqlite3
-from typing import Literal
+import threading
+from typing import Iterable, Literal
 
+from .utils import _locked
+
+
+logger = logging.getLogger("taggerbot.tags")
 
 Tag_t = collections.namedtuple("tag_t", ("ts", "text", "vote", "msg_id", "hier"))
 
@@ -9,14 +15,53 @@ Tag_t = collections.namedtuple("tag_t", ("ts", "text", "vote", "msg_id", "hier")
 class TagDatabase:
 
     TABLE_NAME = "tags"
+    RECENT_IDS_LIM = 4096
+    # Tries of a delayed commit, the delay doubling after each failure
+    COMMIT_ATTEMPTS = 6
 
-    def __init__(self, database_name: str) -> None:
+    def __init__(self, database_name: str, commit_delay: float = 0.05) -> None:
+        """New tags are committed together after `commit_delay` seconds,
+        or immediately if it is 0. They are visible to this instance right away.
+        """
         self.database_name = database_name
+        self.commit_delay = commit_delay
+        self._commit_timer: threading.Timer | None = None
+        self._commit_failures = 0
+        # {msg_id: None}, the latest tagged messages, to answer `in` without a query
+        self._recent_ids = collections.OrderedDict[int, None]()
+        # Used from worker threads, one at a time.
         self.con = sqlite3.connect(
-            self.database_name, detect_types=sqlite3.PARSE_DECLTYPES
+            self.database_name,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
         )
+        self._lock = threading.Lock()
+        self._tune()
         self._create_table()
 
+        # {(by author, show hidden, order): query},
+        # constant texts so sqlite3 reuses the statements
+        self._get_tags_sql = {
+            (by_author, show_hidden, order): f"""SELECT timestamp_, message, votes, msg_id, hierarchy
+                FROM {self.TABLE_NAME}
+                WHERE guild=? AND timestamp_ BETWEEN ? AND ?{" AND author=?" if by_author else ""}
+                {"" if show_hidden else "AND hidden=0"} AND votes>=?
+                ORDER BY timestamp_ {order} LIMIT ?"""
+            for by_author in (False, True)
+            for show_hidden in (False, True)
+            for order in ("ASC", "DESC")
+        }
+
+    def _tune(self):
+        # With WAL, a commit appends to the log instead of syncing a rollback journal,
+        # and with synchronous=NORMAL it is only synced at checkpoints.
+        cur = self.con.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA cache_size=-64000")  # KiB
+        cur.execute("PRAGMA mmap_size=268435456")
+
     def _create_table(self):
         cur = self.con.cursor()
         cur.execute(
@@ -24,24 +69,35 @@ class TagDatabase:
             (msg_id INT PRIMARY KEY, guild INT, timestamp_ INT, message TEXT, votes INT,
             author INT, hidden BOOL, hierarchy INT)"""
         )
+        # The hidden and votes filters of get_tags are checked on the index entries,
+        # only the rows that pass are read from the table.
         cur.execute(
-            f"CREATE INDEX IF NOT EXISTS '{self.TABLE_NAME}_gt_index' on '{self.TABLE_NAME}' (guild, timestamp_)"
+            f"CREATE INDEX IF NOT EXISTS '{self.TABLE_NAME}_gthv_index' on '{self.TABLE_NAME}' (guild, timestamp_, hidden, votes)"
+        )
+        cur.execute(
+            f"CREATE INDEX IF NOT EXISTS '{self.TABLE_NAME}_gat_index' on '{self.TABLE_NAME}' (guild, author, timestamp_)"
         )
         self.con.commit()
 
         # Migration
-        CURRENT_VERSION = 2
+        CURRENT_VERSION = 4
         cur = self.con.cursor()
         cur.execute("PRAGMA user_version")
         version = cur.fetchall()[0][0]  # 0 if version is not set (new table)
-        if version != 0 and version < CURRENT_VERSION:
+        if version != 0 and version < 2:
             cur.execute(
                 f"ALTER TABLE {self.TABLE_NAME} ADD COLUMN hierarchy INT DEFAULT 0"
             )
+        if version != 0 and version < 4:
+            # Superseded by the gthv index, of which it is a prefix.
+            cur.execute(f"DROP INDEX IF EXISTS '{self.TABLE_NAME}_gt_index'")
+            # Statistics for the planner to pick between the indexes.
+            cur.execute("ANALYZE")
 
         cur.execute(f"PRAGMA user_version={CURRENT_VERSION}")
         self.con.commit()
 
+    @_locked
     def tag(
         self,
         msg_id: int,
@@ -53,46 +109,114 @@ class TagDatabase:
         hierarchy=0,
     ):
         time = int(time)
-        cur = self.con.cursor()
-        cur.execute(
+        self.con.execute(
             f"INSERT INTO {self.TABLE_NAME} VALUES (?, ?, ?, ?, 0, ?, ?, ?)",
             (msg_id, guild_id, time, text, author_id, hidden, hierarchy),
         )
+        self._commit_soon()
+        self._add_recent(msg_id)
+
+    def _add_recent(self, msg_id: int):
+        self._recent_ids[msg_id] = None
+        if len(self._recent_ids) > self.RECENT_IDS_LIM:
+            self._recent_ids.popitem(last=False)
+
+    def _commit_soon(self):
+        "Commit after commit_delay, so that the tags of a burst share one transaction."
+        if not self.commit_delay:
+            self.con.commit()
+        elif self._commit_timer is None:
+            self._commit_timer = threading.Timer(
+                self.commit_delay * 2**self._commit_failures, self._delayed_commit
+            )
+            self._commit_timer.daemon = True
+            self._commit_timer.start()
+
+    @_locked
+    def _delayed_commit(self):
+        self._commit_timer = None
+        # A no-op if another method has committed meanwhile.
+        try:
+            self.con.commit()
+        except sqlite3.Error as e:
+            # The timer thread would swallow it, and the batch would stay uncommitted.
+            self._commit_failures += 1
+            if self._commit_failures < self.COMMIT_ATTEMPTS:
+                logger.warning(f"Delayed tag commit failed: {e!r}, retrying.")
+                self._commit_soon()
+            else:
+                logger.exception("Delayed tag commit failed, the batch is lost.")
+                self._commit_failures = 0
+                self.con.rollback()
+                self._recent_ids.clear()
+        else:
+            self._commit_failures = 0
+
+    @_locked
+    def flush(self):
+        "Commit the pending tags now."
+        if self._commit_timer is not None:
+            self._commit_timer.cancel()
+            self._commit_timer = None
         self.con.commit()
 
+    def close(self):
+        "Commit the pending tags and close the database. Unusable after that."
+        self.flush()
+        self.con.close()
+
+    @_locked
+    def tag_many(
+        self, rows: Iterable[tuple[int, int, float, str, int, bool, int]]
+    ) -> int:
+        """Insert the tags in one transaction, skipping the ones that already exist.
+        The rows are the arguments of `tag`, in order. Returns the number inserted.
+        """
+        cur = self.con.executemany(
+            f"INSERT OR IGNORE INTO {self.TABLE_NAME} VALUES (?, ?, ?, ?, 0, ?, ?, ?)",
+            (
+                (msg_id, guild_id, int(time), text, author_id, hidden, hierarchy)
+                for msg_id, guild_id, time, text, author_id, hidden, hierarchy in rows
+            ),
+        )
+        self.con.commit()
+        return cur.rowcount
+
+    @_locked
     def update_text(self, msg_id: int, text: str, h: int):
-        cur = self.con.cursor()
-        cur.execute(
+        self.con.execute(
             f"UPDATE {self.TABLE_NAME} SET message=?, hierarchy=? WHERE ?=msg_id",
             (text, h, msg_id),
         )
         self.con.commit()
 
+    @_locked
     def update_time(self, msg_id: int, time: float):
         time = int(time)
-        cur = self.con.cursor()
-        cur.execute(
+        self.con.execute(
             f"UPDATE {self.TABLE_NAME} SET timestamp_=? WHERE ?=msg_id",
             (time, msg_id),
         )
         self.con.commit()
 
+    @_locked
     def increment_vote(self, msg_id: int, add=1):
-        cur = self.con.cursor()
-        cur.execute(
+        self.con.execute(
             f"UPDATE {self.TABLE_NAME} SET votes = votes+? WHERE msg_id = ?",
             (add, msg_id),
         )
         self.con.commit()
 
+    @_locked
     def remove(self, msg_id: int):
-        cur = self.con.cursor()
-        cur.execute(
+        self.con.execute(
             f"DELETE FROM {self.TABLE_NAME} WHERE msg_id = ?",
             (msg_id,),
         )
         self.con.commit()
+        self._recent_ids.pop(msg_id, None)
 
+    @_locked
     def get_tags(
         self,
         guild_id: int,
@@ -106,34 +230,32 @@ class TagDatabase:
     ) -> list[Tag_t]:  # list[tuple[int, str, int, int, int]]:
         "Returns a list of tuples of timestamp, text, votes, msg_id, and hierarchy."
         start, end = int(start), int(end)
-        cur = self.con.cursor()
-        assert isinstance(limit, int)
-        assert order in ("ASC", "DESC")
+        # limit is bound as a parameter, and an unknown order isn't in _get_tags_sql.
         if author_id:
-            cur.execute(
-                f"""SELECT timestamp_, message, votes, msg_id, hierarchy FROM {self.TABLE_NAME}
-                WHERE guild=? AND timestamp_ BETWEEN ? AND ? AND author=?
-                AND (hidden IS FALSE OR hidden=?) AND votes>=?
-                ORDER BY timestamp_ {order} LIMIT {limit}""",
-                (guild_id, start, end, author_id, show_hidden, min_votes),
+            cur = self.con.execute(
+                self._get_tags_sql[True, bool(show_hidden), order],
+                (guild_id, start, end, author_id, min_votes, limit),
             )
         else:
-            cur.execute(
-                f"""SELECT timestamp_, message, votes, msg_id, hierarchy FROM {self.TABLE_NAME}
-                WHERE guild=? AND timestamp_ BETWEEN ? AND ?
-                AND (hidden IS FALSE OR hidden=?) AND votes>=?
-                ORDER BY timestamp_ {order} LIMIT {limit}""",
-                (guild_id, start, end, show_hidden, min_votes),
+            cur = self.con.execute(
+                self._get_tags_sql[False, bool(show_hidden), order],
+                (guild_id, start, end, min_votes, limit),
             )
-        return list(Tag_t(*fetch) for fetch in cur.fetchall())
+        return list(map(Tag_t._make, cur))
 
+    @_locked
     def __contains__(self, msg_id: int):
-        cur = self.con.cursor()
-        cur.execute(f"SELECT * FROM {self.TABLE_NAME} WHERE msg_id=?", (msg_id,))
-        return bool(cur.fetchone())
+        if msg_id in self._recent_ids:
+            return True
+        # Answered from the primary key index, the row itself isn't read.
+        cur = self.con.execute(
+            f"SELECT 1 FROM {self.TABLE_NAME} WHERE msg_id=? LIMIT 1", (msg_id,)
+        )
+        return cur.fetchone() is not None
 
     def __del__(self):
         try:
+            self.con.commit()
             self.con.close()
         except sqlite3.ProgrammingError:
             pass
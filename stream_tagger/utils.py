@@ -1,9 +1,16 @@
 import asyncio as aio
+import functools
 import sqlite3
-from typing import AsyncGenerator, Callable, Collection, Generator, Hashable, TypeVar
+import threading
+from typing import AsyncGenerator, Callable, Collection, Generator, Generic, Hashable, TypeVar
 import logging
+import pickle
+import random
 import time
+from collections import OrderedDict
 from collections.abc import MutableMapping
+from itertools import groupby
+from operator import itemgetter
 from ast import literal_eval
 
 
@@ -15,10 +22,49 @@ KT = TypeVar("KT", bound=Hashable)
 VT = TypeVar("VT", bound=Hashable)
 
 
+def pickle_dump(value) -> bytes:
+    return pickle.dumps(value, protocol=5)
+
+
+def compat_load(data: bytes | str):
+    "Load a pickled value, or a repr written before pickle was the default."
+    if isinstance(data, bytes):
+        return pickle.loads(data)
+    return literal_eval(data)
+
+
+# Number of keys or values remembered to round trip, per instance
+VALIDATED_LIM = 4096
+
+
+def _round_trips(x, dump: Callable, load: Callable, validated: set) -> bool:
+    "Whether x is equal to itself after dump and load. Remembers the ones that are."
+    if x in validated:
+        return True
+    if x != load(dump(x)):
+        return False
+    if len(validated) >= VALIDATED_LIM:
+        validated.clear()
+    validated.add(x)
+    return True
+
+
+def _locked(method):
+    "Hold the instance's lock, `self._lock`, during the method."
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
 class PersistentDict(MutableMapping[KT, VT]):
     """Dictionary that loads from database upon initilization,
     and writes to it with every set operation.
-    The cache goes stale in cache_duration seconds, if not None.
+    If cache_duration is not None, every cache_duration seconds it checks whether
+    another connection wrote to the database, and reloads if so.
     """
 
     def __init__(
@@ -26,8 +72,8 @@ class PersistentDict(MutableMapping[KT, VT]):
         database: str,
         table_name: str,
         cache_duration: float | None = None,
-        dump_v: Callable[[VT], str | bytes] = repr,
-        load_v: Callable[[bytes | str], VT] | Callable[[str], VT] = literal_eval,
+        dump_v: Callable[[VT], str | bytes] = pickle_dump,
+        load_v: Callable[[bytes | str], VT] | Callable[[str], VT] = compat_load,
     ):
         self.database = database
         self.table_name = table_name
@@ -38,91 +84,145 @@ class PersistentDict(MutableMapping[KT, VT]):
         self._store = dict[KT, VT]()
         self._cache_valid = False
         self._last_cache = float("-inf")
+        # PRAGMA data_version when loaded, changed by commits of other connections
+        self._data_version: int | None = None
+        # The statements only depend on the table name.
+        self._sql_insert = f"INSERT OR REPLACE INTO '{table_name}' VALUES (?, ?)"
+        self._sql_delete = f"DELETE FROM '{table_name}' WHERE key_ = ?"
+
+        # Kept open for the instance's lifetime, used from any thread one at a time.
+        self.con = sqlite3.connect(self.database, check_same_thread=False)
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self._lock = threading.RLock()
+        # Keys and values already known to survive serialization
+        self._valid_keys = set()
+        self._valid_values = set()
 
         assert table_name not in assigned_table_names
         self._create_table()
+        self._populate_from_sql()
 
         assigned_table_names.add(table_name)
 
+    @_locked
     def drop(self):
         "Drop the sql table. This object mustn't be used after that."
-        con = sqlite3.connect(self.database)
-        cur = con.cursor()
+        cur = self.con.cursor()
         cur.execute(f"DROP TABLE IF EXISTS '{self.table_name}'")
-        con.commit()
-        con.close()
+        self.con.commit()
 
+    @_locked
+    def close(self):
+        "Close the database connection. This object mustn't be used after that."
+        self.con.close()
+
+    def __del__(self):
+        try:
+            self.con.close()
+        except AttributeError:
+            pass
+
+    @_locked
     def _create_table(self):
-        con = sqlite3.connect(self.database)
-        cur = con.cursor()
+        cur = self.con.cursor()
+        # Persists in the database file, commits then don't sync a rollback journal.
+        cur.execute("PRAGMA journal_mode=WAL")
         cur.execute(
             f"CREATE TABLE IF NOT EXISTS '{self.table_name}' (key_ PRIMARY KEY, value_)"
         )
-        con.commit()
-        con.close()
+        self.con.commit()
 
+    @_locked
     def _populate_from_sql(self):
-        con = sqlite3.connect(self.database)
-        cur = con.cursor()
+        cur = self.con.cursor()
         cur.execute(f"SELECT key_, value_ FROM '{self.table_name}'")
-        tuple_results = cur.fetchall()
-        store = dict[KT, VT]()
-        for key, value in tuple_results:
-            store[literal_eval(key)] = self.load_v(value)
-        self._store = store
+        # Decoded straight from the cursor, without a list of the rows in between.
+        self._store = dict[KT, VT](
+            (literal_eval(key), self.load_v(value)) for key, value in cur
+        )
         self._cache_valid = True
         self._last_cache = time.monotonic()
+        self._data_version = cur.execute("PRAGMA data_version").fetchone()[0]
+
+    @_locked
+    def _db_changed(self) -> bool:
+        "Whether another connection committed to the database since the last load."
+        cur = self.con.cursor()
+        return cur.execute("PRAGMA data_version").fetchone()[0] != self._data_version
 
     def _calc_cache_staleness(self):
         if (
             self.cache_duration is not None
             and time.monotonic() - self._last_cache > self.cache_duration
         ):
-            self._cache_valid = False
-
-    def __getitem__(self, key: KT):
+            # A cheap one row query instead of reloading the whole table.
+            if self._db_changed():
+                self._cache_valid = False
+            else:
+                self._last_cache = time.monotonic()
+
+    @_locked
+    def _current_store(self) -> dict[KT, VT]:
+        """The cached dict, reloaded first if it's stale.
+        Writes change it in place, iterating it mustn't overlap writes from other threads.
+        """
         self._calc_cache_staleness()
         if not self._cache_valid:
             self._populate_from_sql()
-        return self._store[key]
+        return self._store
+
+    def __getitem__(self, key: KT):
+        return self._current_store()[key]
 
+    @_locked
     def __setitem__(self, key: KT, value: VT):
         # test validity
-        if not (key == literal_eval(repr(key)) and value == self.load_v(self.dump_v(value))):  # type: ignore
+        if not (
+            _round_trips(key, repr, literal_eval, self._valid_keys)
+            and _round_trips(value, self.dump_v, self.load_v, self._valid_values)
+        ):
             raise ValueError
 
-        con = sqlite3.connect(self.database)
-        cur = con.cursor()
+        cur = self.con.cursor()
         cur.execute(
-            f"INSERT OR REPLACE INTO '{self.table_name}' VALUES (?, ?)",
+            self._sql_insert,
             (repr(key), self.dump_v(value)),
         )
-        con.commit()
-        con.close()
+        self.con.commit()
         self._store[key] = value
 
+    @_locked
     def __delitem__(self, key: KT):
-        con = sqlite3.connect(self.database)
-        cur = con.cursor()
-        cur.execute(f"DELETE FROM '{self.table_name}' WHERE key_ = ?", (repr(key),))
-        con.commit()
-        con.close()
+        cur = self.con.cursor()
+        cur.execute(self._sql_delete, (repr(key),))
+        self.con.commit()
         try:
             del self._store[key]
         except KeyError:
             pass
 
     def __iter__(self):
-        self._calc_cache_staleness()
-        if not self._cache_valid:
-            self._populate_from_sql()
-        return iter(self._store)
+        return iter(self._current_store())
 
     def __len__(self):
-        self._calc_cache_staleness()
-        if not self._cache_valid:
-            self._populate_from_sql()
-        return len(self._store)
+        return len(self._current_store())
+
+    # The Mapping defaults would go through __getitem__ for every key,
+    # and __contains__ would raise a KeyError for every miss.
+    def __contains__(self, key) -> bool:
+        return key in self._current_store()
+
+    def get(self, key: KT, default=None):
+        return self._current_store().get(key, default)
+
+    def keys(self):
+        return self._current_store().keys()
+
+    def items(self):
+        return self._current_store().items()
+
+    def values(self):
+        return self._current_store().values()
 
 
 KTT = tuple
@@ -139,8 +239,8 @@ class PersistentSetDict(MutableMapping[KTT, frozenset[VT]]):
         database: str,
         table_name: str,
         depth: int,
-        dump_v: Callable[[VT], str | bytes] = repr,
-        load_v: Callable[[bytes | str], VT] | Callable[[str], VT] = literal_eval,
+        dump_v: Callable[[VT], str | bytes] = pickle_dump,
+        load_v: Callable[[bytes | str], VT] | Callable[[str], VT] = compat_load,
     ):
         self.database = database
         self.table_name = table_name
@@ -149,26 +249,57 @@ class PersistentSetDict(MutableMapping[KTT, frozenset[VT]]):
         self.load_v = load_v
 
         self._store = dict[KTT, set[VT]]()
+        # {keys: frozen copy of the set}, the copies handed out by __getitem__
+        self._frozen = dict[KTT, frozenset[VT]]()
         self._cache_valid = False
+        # Incremented with every change, so users can tell their derived data is stale.
+        self.version = 0
         self._keys = [f"key_{i}" for i in range(self.depth)]
         self._key_names = ",".join(self._keys)
+        # The statements only depend on the table layout.
+        where_keys = " AND ".join(key + " = ?" for key in self._keys)
+        self._sql_insert = (
+            f"INSERT INTO '{table_name}' VALUES ({','.join(['?'] * depth)}, ?)"
+        )
+        self._sql_delete_key = f"DELETE FROM '{table_name}' WHERE {where_keys}"
+        # Rows written before pickle was the default hold the repr.
+        self._sql_delete_keyval = self._sql_delete_key + " AND value_ IN (?, ?)"
+
+        # Kept open for the instance's lifetime, used from any thread one at a time.
+        self.con = sqlite3.connect(self.database, check_same_thread=False)
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self._lock = threading.RLock()
+        # Keys and values already known to survive serialization
+        self._valid_keys = set()
+        self._valid_values = set()
 
         assert table_name not in assigned_table_names
         self._create_table()
 
         assigned_table_names.add(table_name)
 
+    @_locked
     def drop(self):
         "Drop the sql table. This object mustn't be used after that."
-        con = sqlite3.connect(self.database)
-        cur = con.cursor()
+        cur = self.con.cursor()
         cur.execute(f"DROP TABLE IF EXISTS '{self.table_name}'")
-        con.commit()
-        con.close()
+        self.con.commit()
+
+    @_locked
+    def close(self):
+        "Close the database connection. This object mustn't be used after that."
+        self.con.close()
+
+    def __del__(self):
+        try:
+            self.con.close()
+        except AttributeError:
+            pass
 
+    @_locked
     def _create_table(self):
-        con = sqlite3.connect(self.database)
-        cur = con.cursor()
+        cur = self.con.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
         cur.execute(
             f"""CREATE TABLE IF NOT EXISTS '{self.table_name}' (
                 {self._key_names} ,
@@ -176,37 +307,46 @@ class PersistentSetDict(MutableMapping[KTT, frozenset[VT]]):
                 UNIQUE({self._key_names}, value_)
                 ON CONFLICT REPLACE)"""
         )
-        con.commit()
-        con.close()
+        self.con.commit()
 
+    @_locked
     def _populate_from_sql(self):
-        con = sqlite3.connect(self.database)
-        cur = con.cursor()
-        cur.execute(f"SELECT {self._key_names}, value_ FROM '{self.table_name}'")
-        tuple_results = cur.fetchall()
+        cur = self.con.cursor()
+        # Ordered by the UNIQUE index, so the rows of a set come together
+        # and its keys are decoded once.
+        cur.execute(
+            f"""SELECT {self._key_names}, value_ FROM '{self.table_name}'
+            ORDER BY {self._key_names}"""
+        )
+        load_v = self.load_v
         store = dict[KTT, set[VT]]()
-
-        for result in tuple_results:
-            keys = tuple(literal_eval(key) for key in result[:-1])
-            value = result[-1]
-            store.setdefault(keys, set()).add(self.load_v(value))
+        for key_strs, rows in groupby(cur, key=itemgetter(slice(-1))):
+            keys = tuple(map(literal_eval, key_strs))
+            store.setdefault(keys, set()).update(load_v(row[-1]) for row in rows)
 
         self._store = store
+        self._frozen.clear()
         self._cache_valid = True
+        self.version += 1
 
+    @_locked
     def __getitem__(self, keys: KTT) -> frozenset[VT]:
         if len(keys) != self.depth:
             raise TypeError
         if not self._cache_valid:
             self._populate_from_sql()
 
-        return frozenset(self._store[tuple(keys)])
+        keys = tuple(keys)
+        if (frozen := self._frozen.get(keys)) is None:
+            frozen = self._frozen[keys] = frozenset(self._store[keys])
+        return frozen
 
+    @_locked
     def add(self, *keys, value: VT):
         # test validity
-        if any(key != literal_eval(repr(key)) for key in keys) or value != self.load_v(
-            self.dump_v(value)  # type: ignore
-        ):
+        if not all(
+            _round_trips(key, repr, literal_eval, self._valid_keys) for key in keys
+        ) or not _round_trips(value, self.dump_v, self.load_v, self._valid_values):
             raise ValueError
 
         if len(keys) != self.depth:
@@ -214,52 +354,59 @@ class PersistentSetDict(MutableMapping[KTT, frozenset[VT]]):
 
         key_strs = tuple(repr(key) for key in keys)
 
-        con = sqlite3.connect(self.database)
-        cur = con.cursor()
+        cur = self.con.cursor()
         cur.execute(
-            f"""INSERT INTO '{self.table_name}'
-            VALUES ({','.join(['?'] * self.depth)}, ?)""",
+            self._sql_insert,
             key_strs + ((self.dump_v(value),)),
         )
-        con.commit()
-        con.close()
+        self.con.commit()
 
-        self._store.setdefault(tuple(keys), set()).add(value)
+        self._store.setdefault(keys, set()).add(value)
+        self._frozen.pop(keys, None)
+        self.version += 1
 
+    @_locked
     def __setitem__(self, keys: KTT, value_set: Collection[VT]):
 
         # test validity
-        if any(key != literal_eval(repr(key)) for key in keys) or any(
-            value != self.load_v(self.dump_v(value)) for value in value_set  # type: ignore
+        if not all(
+            _round_trips(key, repr, literal_eval, self._valid_keys) for key in keys
+        ) or not all(
+            _round_trips(value, self.dump_v, self.load_v, self._valid_values)
+            for value in value_set
         ):
             raise ValueError
 
         if len(keys) != self.depth:
             raise TypeError
 
+        keys = tuple(keys)
         key_strs = tuple(repr(key) for key in keys)
 
-        con = sqlite3.connect(self.database)
-        cur = con.cursor()
-
-        cur.execute(
-            f"""DELETE FROM '{self.table_name}' WHERE
-            {' AND '.join(key+' = ?' for key in self._keys)}""",
-            key_strs,
-        )
-
-        for value in value_set:
-
-            cur.execute(
-                f"""INSERT INTO '{self.table_name}'
-                VALUES ({','.join(['?'] * self.depth)}, ?)""",
-                key_strs + ((self.dump_v(value),)),
+        if not self._cache_valid:
+            self._populate_from_sql()
+        # Only the difference to the current set is written.
+        new_set = set(value_set)
+        old_set = self._store.get(keys, set())
+        removed = old_set - new_set
+        added = new_set - old_set
+
+        if removed or added:
+            cur = self.con.cursor()
+            cur.executemany(
+                self._sql_delete_keyval,
+                [key_strs + (self.dump_v(value), repr(value)) for value in removed],
             )
+            cur.executemany(
+                self._sql_insert,
+                [key_strs + (self.dump_v(value),) for value in added],
+            )
+            self.con.commit()
+        self._store[keys] = new_set
+        self._frozen.pop(keys, None)
+        self.version += 1
 
-        con.commit()
-        con.close()
-        self._store[tuple(keys)] = set(value_set)
-
+    @_locked
     def remove(self, *keys, value: VT):
         "Can raise `KeyError`."
         if len(keys) != self.depth:
@@ -267,49 +414,52 @@ class PersistentSetDict(MutableMapping[KTT, frozenset[VT]]):
 
         key_strs = tuple(repr(key) for key in keys)
 
-        con = sqlite3.connect(self.database)
-        cur = con.cursor()
+        cur = self.con.cursor()
         cur.execute(
-            f"""DELETE FROM '{self.table_name}' WHERE
-            {' AND '.join(key+' = ?' for key in self._keys)}
-            AND value_ = ?""",
-            key_strs + ((repr(value),)),
+            self._sql_delete_keyval,
+            key_strs + (self.dump_v(value), repr(value)),
         )
-        con.commit()
-        con.close()
+        self.con.commit()
 
-        self._store[tuple(keys)].remove(value)
+        self.version += 1
+        self._frozen.pop(keys, None)
+        self._store[keys].remove(value)
 
+    @_locked
     def __delitem__(self, keys: KTT):
         if len(keys) != self.depth:
             raise TypeError
 
+        keys = tuple(keys)
         key_strs = tuple(repr(key) for key in keys)
 
-        con = sqlite3.connect(self.database)
-        cur = con.cursor()
+        cur = self.con.cursor()
         cur.execute(
-            f"""DELETE FROM '{self.table_name}' WHERE
-            {' AND '.join(key+' = ?' for key in self._keys)}""",
+            self._sql_delete_key,
             key_strs,
         )
-        con.commit()
-        con.close()
+        self.con.commit()
+        self.version += 1
+        self._frozen.pop(keys, None)
         try:
-            del self._store[tuple(keys)]
+            del self._store[keys]
         except KeyError:
             pass
 
+    @_locked
     def __iter__(self):
         if not self._cache_valid:
             self._populate_from_sql()
-        return iter(self._store)
+        # A copy, writes from other threads would change the size mid-iteration.
+        return iter(tuple(self._store))
 
+    @_locked
     def __len__(self):
         if not self._cache_valid:
             self._populate_from_sql()
         return len(self._store)
 
+    @_locked
     def __contains__(self, keys) -> bool:
         if not self._cache_valid:
             self._populate_from_sql()
@@ -328,25 +478,39 @@ def str_to_time_d(time_str: str) -> int:
             raise ValueError
 
 
+# (year, month, day), start of that day
+_today_start: tuple[tuple[int, ...], int] = ((), 0)
+
+
 def str_to_time(time_str: str) -> int:
     "If hours supplied, return today + hours. Otherwise, accept as timestamp"
+    global _today_start
     if ":" in time_str:
         hours = str_to_time_d(time_str)
         today_start_st = time.gmtime()
-        today_start = time.mktime(today_start_st[:3] + (0, 0, 0) + today_start_st[6:])
-        return hours + int(today_start)
+        if today_start_st[:3] != _today_start[0]:
+            _today_start = today_start_st[:3], int(
+                time.mktime(today_start_st[:3] + (0, 0, 0) + today_start_st[6:])
+            )
+        return hours + _today_start[1]
     else:
         return int(time_str)
 
 
 class ExpBackoff:
-    def __init__(self, backoff: float = 2, cooldown: float = 0.9):
+    def __init__(self, backoff: float = 2, cooldown: float = 0.9, max_wait: float = 60):
         self.backoff_factor = backoff
         self.cooldown_factor = cooldown
+        self.max_wait = max_wait
         self._current_wait: float = 0
         self._last_backoff = 0
 
-    def backoff(self):
+    def backoff(self, sent_at: float | None = None):
+        """sent_at is when the failed request was sent. Failures of requests sent
+        before the last backoff are of the same burst, and don't back off again.
+        """
+        if sent_at is not None and sent_at < self._last_backoff:
+            return
         self._last_backoff = time.time()
         if self._current_wait == 0:
             self._current_wait = 1
@@ -363,7 +527,45 @@ class ExpBackoff:
     async def wait(self):
         if self._current_wait > 0.2:
             logger.warning(f"Current backoff: {self._current_wait:.3f}")
-        await aio.sleep(self.current_wait)
+        # Full jitter, so that the concurrent waiters don't all retry at once.
+        await aio.sleep(
+            random.uniform(0, min(self.max_wait, max(self.current_wait, 0)))
+        )
+
+
+class TTLCache(Generic[KT, VT]):
+    """In-memory cache whose entries go stale in ttl seconds.
+    The oldest entry is evicted when there are more than maxsize entries.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._store = OrderedDict[KT, tuple[float, VT]]()
+
+    def get(self, key: KT, default=None):
+        try:
+            expires_at, value = self._store[key]
+        except KeyError:
+            return default
+        if expires_at < time.monotonic():
+            del self._store[key]
+            return default
+        return value
+
+    def set(self, key: KT, value: VT, ttl: float | None = None):
+        "Store value, optionally with a ttl other than the default."
+        ttl = self.ttl if ttl is None else ttl
+        self._store[key] = (time.monotonic() + ttl, value)
+        self._store.move_to_end(key)
+        while len(self._store) > self.maxsize:
+            self._store.popitem(last=False)
+
+    def clear(self):
+        self._store.clear()
+
+    def __len__(self):
+        return len(self._store)
 
 
 # class ConcurrentRatelimit:
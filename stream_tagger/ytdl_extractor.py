@@ -1,4 +1,6 @@
 import logging
+import os
+import threading
 import time
 from typing import Iterable, Mapping
 
@@ -8,6 +10,24 @@ import yt_dlp as ytdl
 
 logger = logging.getLogger("stream_extractor")
 
+ytdl_logger = logging.getLogger("ytdl_fetchinfo")
+ytdl_logger.propagate = False
+ytdl_logger.addHandler(logging.NullHandler())  # f yt-dl logs
+
+COOKIE_FILE = ".cookies.txt"
+
+# YoutubeDL isn't thread safe, so each worker thread keeps its own,
+# {(no_playlist, playlist_items, is_youtube): YoutubeDL}
+_thread_ydls = threading.local()
+# Every kept YoutubeDL, to close them at shutdown
+_all_ydls = list[ytdl.YoutubeDL]()
+# Held while a YoutubeDL reads or writes the cookie file
+_cookies_lock = threading.Lock()
+
+
+# Tries on cookie file errors, the waits in between double from 1 second.
+COOKIE_ATTEMPTS = 3
+
 
 class RateLimited(Exception):
     pass
@@ -26,9 +46,10 @@ def fetch_yt_metadata(
     """
     logger.info(f"yt-dl query for: {url, no_playlist, playlist_items}")
 
-    ytdl_logger = logging.getLogger("ytdl_fetchinfo")
-    ytdl_logger.propagate = False
-    ytdl_logger.addHandler(logging.NullHandler())  # f yt-dl logs
+    playlist_str = ",".join(str(it) for it in playlist_items)
+    is_youtube = "youtube.com/" in url
+    opts_key = (no_playlist, playlist_str, is_youtube)
+    ydls: dict = _thread_ydls.__dict__.setdefault("ydls", {})
 
     # options referenced from
     # https://github.com/sparanoid/live-dl/blob/3e76be969d94747aa5d9f83b34bc22e14e0929be/live-dl
@@ -38,41 +59,68 @@ def fetch_yt_metadata(
     ydl_opts = {
         "logger": ytdl_logger,
         "noplaylist": no_playlist,
-        "playlist_items": ",".join(str(it) for it in playlist_items),
+        "playlist_items": playlist_str,
         "skip_download": True,
         "forcejson": True,
         "no_color": True,
-        "cookiefile": ".cookies.txt",
+        "cookiefile": COOKIE_FILE,
         "ignore_no_formats_error": True,
     }
 
-    if "youtube.com/" in url:
+    if is_youtube:
         ydl_opts["referer"] = "https://www.youtube.com/feed/subscriptions"
 
-    try:
-        with ytdl.YoutubeDL(ydl_opts) as ydl:
-            info_dict: Mapping = ydl.extract_info(url, download=False)
-    except ytdl.utils.DownloadError as e:
-        # "<channel_name> is offline error is possible in twitch
-        if "This live event will begin in" in e.args[0] or "is offline" in e.args[0]:
-            logger.debug(e)
-        elif "HTTP Error 429" in e.args[0]:
-            logger.critical(f'Got "{e}", for {url}.')
-            raise RateLimited
-        elif "members-only" in e.args[0].lower() or "private" in e.args[0].lower():
-            raise PayWalled()
+    for attempt in range(COOKIE_ATTEMPTS):
+        try:
+            # Reused, so the extractors are set up once per thread.
+            if (ydl := ydls.get(opts_key)) is None:
+                ydl = ydls[opts_key] = ytdl.YoutubeDL(ydl_opts)
+                with _cookies_lock:
+                    _all_ydls.append(ydl)
+            with _cookies_lock:
+                # Other threads may have saved newer cookies since this one loaded.
+                ydl.cookiejar.clear()
+                if os.access(COOKIE_FILE, os.R_OK):
+                    ydl.cookiejar.load()
+            try:
+                info_dict: Mapping = ydl.extract_info(url, download=False)
+            finally:
+                with _cookies_lock:
+                    ydl.save_cookies()
+        except ytdl.utils.DownloadError as e:
+            # "<channel_name> is offline error is possible in twitch
+            if "This live event will begin in" in e.args[0] or "is offline" in e.args[0]:
+                logger.debug(e)
+            elif "HTTP Error 429" in e.args[0]:
+                logger.critical(f'Got "{e}", for {url}.')
+                raise RateLimited
+            elif "members-only" in e.args[0].lower() or "private" in e.args[0].lower():
+                raise PayWalled()
+            else:
+                logger.error(f"{e}, for {url}.")
+
+            return None
+        except http.cookiejar.LoadError as e:
+            logger.error(f"Cookie error: {e}. Attempt {attempt + 1}/{COOKIE_ATTEMPTS}")
+            if (ydl := ydls.pop(opts_key, None)) is not None:
+                with _cookies_lock:
+                    _all_ydls.remove(ydl)
+            if attempt + 1 < COOKIE_ATTEMPTS:
+                time.sleep(2**attempt)
+        except Exception as e:
+            logger.exception(e)
+            return None
         else:
-            logger.error(f"{e}, for {url}.")
-
-        return None
-    except http.cookiejar.LoadError as e:
-        logger.error(f"Cookie error: {e}. Trying again")
-        time.sleep(1)
-        return fetch_yt_metadata(url)
-    except Exception as e:
-        logger.exception(e)
-        return None
-    return info_dict
+            return info_dict
+    return None
+
+
+def close_ytdl():
+    "Close the kept YoutubeDLs. Call at shutdown, after the last fetch."
+    with _cookies_lock:
+        for ydl in _all_ydls:
+            ydl.close()
+        _all_ydls.clear()
 
 
 if __name__ == "__main__":